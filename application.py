@@ -1,7 +1,12 @@
+import time
+START_TIME = time.time()
+
 import os
+import sys
 from gi.repository import Gtk, Gio, GObject, GLib
 from optparse import OptionParser
-from epubreader import EpubReader
+# epubreader and epubserver pull in WebKit and Soup, so they are imported
+# only once this is known to be the primary instance.
 
 class Application(Gtk.Application):
     
@@ -10,8 +15,16 @@ class Application(Gtk.Application):
                                  flags=Gio.ApplicationFlags.FLAGS_NONE)
         self.connect('startup', self.on_startup)
         self.connect('activate', self.on_activate)
+        self.connect('shutdown', self.on_shutdown)
         self.files = None
         self.debug = False
+        # Hand each book's reader page to the WebView with its scripts and
+        # styles inlined, rather than loading them over HTTP, where WebKit
+        # can cache them between windows
+        self.inline = False
+        self._server = None
+        self._store = None
+        self.marks = []
     
     def on_startup(self, data=None):
         for name, ptype, callback in (('open', None, self.on_open),
@@ -44,10 +57,49 @@ class Application(Gtk.Application):
         </interface>
         ''')
         self.set_app_menu(builder.get_object('app-menu'))
+        self.mark('startup')
+    
+    @property
+    def server(self):
+        """One server for all windows, so they share the bundled resources and
+        open books.  It's started when the first window needs it."""
+        if self._server is None:
+            from epubserver import EpubServer
+            self._server = EpubServer()
+            self._server.trace = self.debug
+            if self.debug:
+                self._server.assets.watch()
+            self.mark('server')
+        return self._server
+    
+    @property
+    def store(self):
+        """Reading positions and settings, shared by all windows."""
+        if self._store is None:
+            from store import Store
+            self._store = Store()
+        return self._store
+    
+    def on_shutdown(self, data=None):
+        if self._store is not None:
+            self._store.close()
+    
+    def mark(self, stage):
+        """Note how long after launch stage was first reached, printing it
+        with --debug."""
+        if stage in dict(self.marks):
+            return
+        self.marks.append((stage, time.time() - START_TIME))
+        if self.debug:
+            self.print_mark(*self.marks[-1])
+    
+    def print_mark(self, stage, elapsed):
+        sys.stderr.write('startup: %-12s %8.1f ms\n' % (stage, elapsed * 1000))
     
     def on_activate(self, application, data=None):
         if self.files is None:
             return
+        self.mark('activate')
         
         for f in self.files:
             self.load_file(f)
@@ -61,12 +113,15 @@ class Application(Gtk.Application):
             else:
                 windows[0].present()
         else:
+            from epubreader import EpubReader
             EpubReader(self)
     
     def run(self, args):
         parser = OptionParser(usage="Usage", description="Description", version="version")
         parser.add_option('-d', '--debug', action='store_true', default=False,
                           help='print debugging information')
+        parser.add_option('--inline', action='store_true', default=False,
+                          help='inline the reader page and its scripts, rather than using HTTP')
         options, args = parser.parse_args(args)
         files = [os.path.abspath(arg) for arg in args if os.path.isfile(arg)]
         
@@ -77,6 +132,11 @@ class Application(Gtk.Application):
         else:
             self.files = files
             self.debug = options.debug
+            self.inline = options.inline
+            if self.debug:
+                for mark in self.marks:
+                    self.print_mark(*mark)
+            self.mark('registered')
         Gtk.Application.run(self, None)  # Will trigger 'activate' signal
     
     def on_set_files(self, action, gv_files):
@@ -84,6 +144,8 @@ class Application(Gtk.Application):
     
     def on_set_debug(self, action, gv_debug):
         self.debug = gv_debug.unpack()
+        if self._server is not None:
+            self._server.trace = self.debug
     
     def on_open(self, action, data=None):
         dialog = Gtk.FileChooserDialog("Open...", None, Gtk.FileChooserAction.OPEN,
@@ -107,10 +169,11 @@ class Application(Gtk.Application):
     
     def load_file(self, filename):
         for window in self.get_windows():
-            if window.server.epub is None:
+            if window.book is None:
                 window.load_file_lazy(filename)
                 return
         
+        from epubreader import EpubReader
         EpubReader(self, filename)
 
 
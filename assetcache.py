@@ -0,0 +1,79 @@
+from gi.repository import Gio
+import os
+import zlib
+import hashlib
+
+class Asset(object):
+    """A response body held in memory, with a gzipped copy if it's worth it."""
+    
+    # Types worth sending gzip-encoded
+    COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+    
+    def __init__(self, data, content_type, mtime, etag=None):
+        self.data = data
+        self.content_type = content_type
+        self.mtime = mtime
+        self.etag = etag or '"%s"' % hashlib.sha1(data).hexdigest()[:20]
+        self.gzipped = None
+        if content_type.startswith(self.COMPRESSIBLE):
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            gzipped = compressor.compress(self.data) + compressor.flush()
+            if len(gzipped) < len(self.data):
+                self.gzipped = gzipped
+    
+    @classmethod
+    def from_file(cls, path, content_type):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+        return cls(data, content_type, stat.st_mtime,
+                   '"%x-%x"' % (int(stat.st_mtime), stat.st_size))
+
+
+class AssetCache(object):
+    """Keep the files in a directory in memory, along with gzipped copies of
+    the text files.  Files outside the directory are loaded on first use."""
+    
+    def __init__(self, directory, guess_type):
+        self.directory = directory
+        self.guess_type = guess_type
+        self.assets = {}
+        self.monitors = {}
+        self.warm()
+    
+    def warm(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                self.get(os.path.join(dirpath, filename))
+    
+    def get(self, path):
+        """Return the Asset for path, relative to the directory, or None if
+        it doesn't exist."""
+        path = os.path.normpath(os.path.join(self.directory, path))
+        asset = self.assets.get(path)
+        if asset is None:
+            try:
+                asset = self.assets[path] = Asset.from_file(path, self.guess_type(path))
+            except IOError:
+                return None
+        return asset
+    
+    def invalidate(self, path=None):
+        """Drop path, or everything, from the cache.  It will be reread on the
+        next request."""
+        if path is None:
+            self.assets.clear()
+        else:
+            self.assets.pop(os.path.normpath(os.path.join(self.directory, path)), None)
+    
+    def watch(self):
+        """Invalidate files as they change on disk.  Useful while developing."""
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            if dirpath not in self.monitors:
+                monitor = Gio.File.new_for_path(dirpath).monitor_directory(
+                        Gio.FileMonitorFlags.NONE, None)
+                monitor.connect('changed', self.on_changed)
+                self.monitors[dirpath] = monitor
+    
+    def on_changed(self, monitor, gfile, other_file, event_type):
+        self.invalidate(gfile.get_path())
@@ -0,0 +1,299 @@
+"""Headless benchmarks for the EPUB parser and server.
+
+Generates synthetic books and times Epub construction, the .bookdata.js
+payload, and requests to an EpubServer through httplib, without starting
+the Application or a WebView.  Results can be saved as a baseline and
+compared against in later runs:
+    
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json
+"""
+
+from gi.repository import GLib
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import httplib
+import resource
+import tempfile
+import threading
+import subprocess
+import zipfile
+from optparse import OptionParser
+import epubserver
+
+CONTAINER = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>'''
+
+def make_epub(path, version=2, spine=50, toc_depth=2, members=200, image_size=100 * 1024,
+              paragraphs=200):
+    """Write a synthetic EPUB to path.  Any members beyond the spine, its
+    table of contents, and a stylesheet are random (incompressible) images
+    of image_size bytes, spread over the spine documents."""
+    rand = random.Random(path)
+    images = max(members - spine - 4, 0)
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+    z.writestr('META-INF/container.xml', CONTAINER)
+    
+    items = ['<item id="css" href="style.css" media-type="text/css"/>',
+             '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>']
+    if version == 3:
+        items.append('<item id="nav" href="nav.xhtml" properties="nav" '
+                     'media-type="application/xhtml+xml"/>')
+    for i in range(spine):
+        items.append('<item id="c%i" href="text/c%i.xhtml" media-type="application/xhtml+xml"/>'
+                     % (i, i))
+    for i in range(images):
+        items.append('<item id="i%i" href="images/i%i.jpg" media-type="image/jpeg"/>' % (i, i))
+    z.writestr('OEBPS/content.opf', '''<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="%i.0" unique-identifier="uid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Benchmark</dc:title>
+<dc:creator>bench.py</dc:creator><dc:identifier id="uid">urn:uuid:%s</dc:identifier></metadata>
+<manifest>%s</manifest><spine toc="ncx">%s</spine></package>''' % (
+        version, os.path.basename(path), ''.join(items),
+        ''.join('<itemref idref="c%i"/>' % i for i in range(spine))))
+    
+    def ncx_points(i, depth, prefix):
+        label = '%s%i' % (prefix, i)
+        children = ''.join(ncx_points(j, depth - 1, label + '.') for j in range(2)) if depth else ''
+        return ('<navPoint id="n%s"><navLabel><text>Section %s</text></navLabel>'
+                '<content src="text/c%i.xhtml#s%s"/>%s</navPoint>' % (label, label, i, label,
+                                                                       children))
+    
+    def nav_items(i, depth, prefix):
+        label = '%s%i' % (prefix, i)
+        children = ''.join(nav_items(j, depth - 1, label + '.') for j in range(2)) if depth else ''
+        return '<li><a href="text/c%i.xhtml#s%s">Section %s</a>%s</li>' % (
+            i, label, label, '<ol>%s</ol>' % children if children else '')
+    
+    z.writestr('OEBPS/toc.ncx', '<?xml version="1.0"?><ncx xmlns="http://www.daisy.org/z3986/'
+               '2005/ncx/" version="2005-1"><navMap>%s</navMap></ncx>'
+               % ''.join(ncx_points(i, toc_depth - 1, '') for i in range(spine)))
+    if version == 3:
+        z.writestr('OEBPS/nav.xhtml', '<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/'
+                   'xhtml" xmlns:epub="http://www.idpf.org/2007/ops"><body><nav epub:type="toc">'
+                   '<ol>%s</ol></nav></body></html>'
+                   % ''.join(nav_items(i, toc_depth - 1, '') for i in range(spine)))
+    z.writestr('OEBPS/style.css', 'p { text-indent: 1em; margin: 0; }')
+    
+    for i in range(spine):
+        body = ''.join('<p>Paragraph %i of chapter %i. %s</p>' % (j, i, ' '.join(
+            rand.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'berg', 'epub'))
+            for k in range(40))) for j in range(paragraphs))
+        body += ''.join('<img src="../images/i%i.jpg"/>' % j for j in range(i, images, spine))
+        z.writestr('OEBPS/text/c%i.xhtml' % i, '<?xml version="1.0"?><html xmlns="http://www.w3.org'
+                   '/1999/xhtml"><head><link rel="stylesheet" href="../style.css"/></head><body>'
+                   '%s</body></html>' % body)
+    for i in range(images):
+        z.writestr('OEBPS/images/i%i.jpg' % i, os.urandom(image_size))
+    z.close()
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)]
+
+def summarize(times):
+    return {'p50_ms': percentile(times, 50) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+            'n': len(times)}
+
+def timed(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+def bench_parse(path, repeat):
+    def open_book(use_cache):
+        epubserver.Epub.use_cache = use_cache
+        epubserver.Epub(path, 'r').close()
+    
+    results = {'epub_open': summarize(timed(lambda: open_book(False), repeat))}
+    open_book(True)  # Fill the cache
+    results['epub_open_cached'] = summarize(timed(lambda: open_book(True), repeat))
+    epubserver.Epub.use_cache = True
+    
+    epub = epubserver.Epub(path, 'r')
+    results['book_data'] = summarize(timed(
+        lambda: epubserver.Asset(("var bookData = %s" % epub.make_book_data()).encode('utf-8'),
+                                 'application/javascript', time.time()), repeat))
+    results['search_index'] = summarize(timed(lambda: epubserver.SearchIndex.build(epub), repeat))
+    index = epubserver.SearchIndex.build(epub)
+    results['search_query'] = summarize(timed(lambda: index.search('berg'), repeat))
+    results['search_query_multi'] = summarize(timed(lambda: index.search('chapter 3 berg epub'),
+                                                    repeat))
+    epub.close()
+    return results
+
+def run_on_loop(func, *args):
+    """Call func on the main loop thread and return its result."""
+    done = threading.Event()
+    result = []
+    def call():
+        result.append(func(*args))
+        done.set()
+        return False
+    GLib.idle_add(call)
+    done.wait()
+    return result[0]
+
+def bench_server(path, requests, clients):
+    loop = GLib.MainLoop()
+    server = epubserver.EpubServer()
+    server.index_on_open = False
+    thread = threading.Thread(target=loop.run)
+    thread.daemon = True
+    thread.start()
+    
+    opened = threading.Event()
+    book = []
+    def open_book():
+        server.open_book(path, lambda book_id: (book.append(book_id), opened.set()),
+                         lambda error: (book.append(error), opened.set()))
+    run_on_loop(open_book)
+    opened.wait()
+    if not isinstance(book[0], basestring):
+        raise book[0]
+    
+    epub = server.books[book[0]]
+    prefix = '/book/%s/' % book[0]
+    urls = [prefix, prefix + '.bookdata.js', '/.js/monocore.js']
+    urls += [prefix + href for href in epub.components()]
+    urls += [prefix + info.filename for info in epub.infolist() if info.filename.endswith('.jpg')]
+    
+    def fetch(conn, url, stats):
+        start = time.time()
+        conn.request('GET', url)
+        response = conn.getresponse()
+        stats['bytes'] += len(response.read())
+        stats['times'].append(time.time() - start)
+        if response.status != 200:
+            stats['errors'] += 1
+    
+    results = {}
+    port = server.get_port()
+    for label in ('request_cold', 'request_warm'):
+        stats = {'bytes': 0, 'times': [], 'errors': 0}
+        conn = httplib.HTTPConnection('localhost', port)
+        for url in urls:
+            fetch(conn, url, stats)
+        conn.close()
+        results[label] = summarize(stats['times'])
+        results[label]['errors'] = stats['errors']
+    
+    stats = {'bytes': 0, 'times': [], 'errors': 0}
+    def client(seed):
+        rand = random.Random(seed)
+        conn = httplib.HTTPConnection('localhost', port)
+        for i in range(requests // clients):
+            fetch(conn, rand.choice(urls), stats)
+        conn.close()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    results['throughput'] = summarize(stats['times'])
+    results['throughput'].update(requests_per_s=len(stats['times']) / elapsed,
+                                 mb_per_s=stats['bytes'] / elapsed / 1e6,
+                                 errors=stats['errors'])
+    
+    run_on_loop(server.release, book[0])
+    loop.quit()
+    return results
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """Print each timing against the baseline, flagging those that got slower
+    by more than tolerance.  Return the number of regressions."""
+    regressions = 0
+    print '\nCompared to %s:' % (baseline.get('revision') or 'baseline')
+    for book, benches in sorted(results['books'].items()):
+        for name, stats in sorted(benches.items()):
+            old = baseline['books'].get(book, {}).get(name)
+            if not old:
+                continue
+            for key in ('p50_ms', 'p99_ms'):
+                change = (stats[key] - old[key]) / old[key] if old[key] else 0
+                flag = ''
+                if change > tolerance:
+                    flag = '  REGRESSION'
+                    regressions += 1
+                print '  %-6s %-18s %-7s %9.2f -> %9.2f (%+.0f%%)%s' % (
+                    book, name, key, old[key], stats[key], change * 100, flag)
+    return regressions
+
+def main(args):
+    parser = OptionParser(usage="python bench.py [options]", description=__doc__.split('\n')[0])
+    parser.add_option('--spine', type='int', default=50, help='spine components per book')
+    parser.add_option('--toc-depth', type='int', default=3, help='depth of the table of contents')
+    parser.add_option('--members', type='int', default=200, help='zip members per book')
+    parser.add_option('--image-size', type='int', default=100, help='size of each image, in KB')
+    parser.add_option('--repeat', type='int', default=20, help='repetitions of each timing')
+    parser.add_option('--requests', type='int', default=1000,
+                      help='requests for the throughput test')
+    parser.add_option('--clients', type='int', default=4, help='concurrent clients')
+    parser.add_option('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_option('--compare', metavar='FILE', help='compare the results to a baseline')
+    parser.add_option('--tolerance', type='float', default=0.1,
+                      help='slowdown, as a fraction, counted as a regression')
+    options, args = parser.parse_args(args)
+    
+    results = {'revision': revision(),
+               'options': dict((key, getattr(options, key)) for key in
+                               ('spine', 'toc_depth', 'members', 'image_size')),
+               'books': {}}
+    tmpdir = tempfile.mkdtemp(prefix='berg-bench-')
+    # Keep the parsed-book cache from filling up with temporary books.
+    os.environ['XDG_CACHE_HOME'] = tmpdir
+    try:
+        for version in (2, 3):
+            path = os.path.join(tmpdir, 'epub%i.epub' % version)
+            make_epub(path, version, options.spine, options.toc_depth, options.members,
+                      options.image_size * 1024)
+            book = results['books']['epub%i' % version] = bench_parse(path, options.repeat)
+            book.update(bench_server(path, options.requests, options.clients))
+    finally:
+        shutil.rmtree(tmpdir)
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    for book, benches in sorted(results['books'].items()):
+        print book
+        for name, stats in sorted(benches.items()):
+            extra = ''
+            if 'requests_per_s' in stats:
+                extra = '  %8.1f req/s %8.1f MB/s' % (stats['requests_per_s'], stats['mb_per_s'])
+            if stats.get('errors'):
+                extra += '  %i errors' % stats['errors']
+            print '  %-18s p50 %9.2f ms  p99 %9.2f ms%s' % (name, stats['p50_ms'],
+                                                            stats['p99_ms'], extra)
+    print 'peak RSS %.1f MB' % (results['peak_rss_kb'] / 1024.0)
+    
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            if compare(results, json.load(f), options.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
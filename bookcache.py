@@ -0,0 +1,125 @@
+from gi.repository import GLib
+import os
+import json
+import time
+import stat
+import hashlib
+import tempfile
+
+CACHE_VERSION = 6
+# Most bytes each cache directory may hold before prune() deletes the least
+# recently used files in it
+CACHE_LIMITS = {('books',): 256 * 1024 * 1024,
+                ('pagination',): 16 * 1024 * 1024,
+                ('images',): 256 * 1024 * 1024,
+                ('fonts',): 64 * 1024 * 1024,
+                ('fonts', 'sources'): 1024 * 1024}
+# Temporary files older than this were left behind by a crash.
+TEMP_MAX_AGE = 3600
+
+def cache_dir(*parts):
+    path = os.path.join(GLib.get_user_cache_dir(), 'berg', *parts)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def fingerprint(zfile):
+    """Identify the contents of an open zip file by its path, size, mtime,
+    and a hash of its central directory."""
+    stat = os.fstat(zfile.fp.fileno())
+    digest = hashlib.sha1(os.path.abspath(zfile.filename).encode('utf-8'))
+    digest.update(('%i %i' % (stat.st_size, stat.st_mtime)).encode('ascii'))
+    zfile.fp.seek(zfile.start_dir)
+    while True:
+        data = zfile.fp.read(64 * 1024)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+def cache_path(zfile, ext):
+    """Where to keep cached data for the book at zfile's path.  There is
+    one such file per path, so they need to be checked against the
+    fingerprint before use."""
+    name = hashlib.sha1(os.path.abspath(zfile.filename).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir('books'), name + ext)
+
+def prune_dir(path, limit):
+    """Delete the least recently used files directly in path until the rest
+    take up no more than limit bytes, along with stale temporary files."""
+    now = time.time()
+    files = []
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        try:
+            info = os.stat(filename)
+        except OSError:
+            continue
+        if not stat.S_ISREG(info.st_mode):
+            continue
+        if name.endswith('.tmp'):
+            if now - info.st_mtime > TEMP_MAX_AGE:
+                remove(filename)
+            continue
+        files.append((max(info.st_atime, info.st_mtime), info.st_size, filename))
+    total = sum(size for used, size, filename in files)
+    for used, size, filename in sorted(files):
+        if total <= limit:
+            break
+        remove(filename)
+        total -= size
+
+def prune():
+    """Keep each cache directory within its limit in CACHE_LIMITS."""
+    for parts, limit in CACHE_LIMITS.items():
+        try:
+            prune_dir(cache_dir(*parts), limit)
+        except OSError:
+            pass
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def write_atomic(path, data):
+    """Write data to path through a temporary file, so that readers never
+    see part of it.  Failures are ignored, since everything written is a
+    cache."""
+    try:
+        fd, temp = tempfile.mkstemp('.tmp', os.path.basename(path) + '.', os.path.dirname(path))
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        remove(temp)
+
+def read_json(path):
+    """Return the data written to path by write_json, or None if there is
+    none or it is from another version."""
+    try:
+        with open(path, 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+        return None
+    return data
+
+def write_json(path, data):
+    write_atomic(path, json.dumps(dict(data, version=CACHE_VERSION)).encode('utf-8'))
+
+def load(epub, ext='.json'):
+    """Return the data stored for epub under ext, or None if there is none
+    or it is out of date."""
+    data = read_json(cache_path(epub, ext))
+    if data is None or data.get('fingerprint') != epub.fingerprint:
+        return None
+    return data
+
+def save(epub, data, ext='.json'):
+    write_json(cache_path(epub, ext), dict(data, fingerprint=epub.fingerprint))
@@ -1,6 +1,8 @@
 from gi.repository import GObject, GLib, Gdk, Gtk, Gio, WebKit
-import epubserver
 from readersettings import ReaderSettings
+import json
+import urllib
+import pagination
 
 NONE, WAITING, ACCEPT, REJECT = range(4)
 
@@ -45,17 +47,21 @@ class EpubReader(Gtk.ApplicationWindow):
         Gtk.ApplicationWindow.__init__(self, application=application,
                                        default_width=450, default_height=600)
         self.application = application
+        self.book = None
+        self.filename = None
+        # Books may finish opening after the window is closed.
+        self.destroyed = False
         self.load_file_lazy(filename)
         
         self.establish_actions()
-        sw = Gtk.ScrolledWindow()
-        sw.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
-        self.view = DNDWebView()
-        self.view.connect('drag-drop', self.on_drag_drop)
-        sw.add(self.view)
-        self.add(sw)
-        self.view.connect('title-changed', self.on_title_changed)
-        self.view.connect('console-message', self.on_console_message)
+        # The WebView, server, and settings dialog are created when first
+        # needed, so that the window can be drawn before WebKit starts up.
+        self.view = None
+        self.drop_target = None
+        self._settings = None
+        self.sw = Gtk.ScrolledWindow()
+        self.sw.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+        self.add(self.sw)
         
         self.hb = Gtk.HeaderBar()
         self.hb.set_show_close_button(True)
@@ -78,16 +84,45 @@ class EpubReader(Gtk.ApplicationWindow):
         self.set_wmclass("Berg", "Berg")
         self.connect('key-press-event', self.on_key_press)
         self.connect('configure-event', self.on_configure)
+        self.connect('destroy', self.on_destroy)
         self._size = (0, 0)
         self._resize_timeout = None
-        
-        self.settings = ReaderSettings(self)
+        self._pagination_timeout = None
+        self.pagination_key = None
+        self.paginator = None
         
         self.show_all()
         self.toc_button.hide()
         self.settings_button.hide()
-        
-        self.spawn_server()
+        self.application.mark('window')
+    
+    @property
+    def server(self):
+        return self.application.server
+    
+    @property
+    def settings(self):
+        if self._settings is None:
+            self._settings = ReaderSettings(self, **self.application.store.settings())
+        return self._settings
+    
+    def ensure_view(self):
+        if self.view is not None:
+            return
+        if self.drop_target is not None:
+            self.sw.remove(self.sw.get_child())
+            self.drop_target = None
+        self.view = DNDWebView()
+        self.view.connect('drag-drop', self.on_drag_drop)
+        self.view.connect('title-changed', self.on_title_changed)
+        self.view.connect('console-message', self.on_console_message)
+        self.sw.add(self.view)
+        self.view.show()
+        self.application.mark('webview')
+    
+    def execute_script(self, script):
+        if self.view is not None:
+            self.view.execute_script(script)
     
     def establish_actions(self):
         action_group = Gtk.ActionGroup('main')
@@ -111,19 +146,74 @@ class EpubReader(Gtk.ApplicationWindow):
         self.ui_manager.ensure_update()
         self.add_accel_group(self.ui_manager.get_accel_group())
     
-    def spawn_server(self):
-        self.server = epubserver.EpubServer()
-        self.port = self.server.get_port()
-    
     def load_file_lazy(self, filename):
         GLib.idle_add(self.load_file, filename)
     
     def load_file(self, filename):
-        self.view.load_uri("http://localhost:%i/?load=%s" % (self.port, filename))
-        if filename:
-            self.open_button.hide()
-            self.settings_button.show()
-            self.toc_button.show()
+        if not filename:
+            self.show_drop_target()
+            return
+        self.ensure_view()
+        self.server.open_book(filename, lambda book_id: self.on_book_opened(book_id, filename),
+                              lambda error: self.on_book_failed(filename, error))
+    
+    def show_drop_target(self):
+        """Show a plain GTK drop target, so that a window without a book
+        needn't start WebKit or the server."""
+        if self.view is not None or self.drop_target is not None:
+            return
+        label = Gtk.Label()
+        label.set_markup('<span size="xx-large" weight="bold" foreground="#aaa">'
+                         'Drop file here</span>')
+        self.drop_target = Gtk.EventBox()
+        self.drop_target.add(label)
+        self.drop_target.drag_dest_set(Gtk.DestDefaults.ALL, [], Gdk.DragAction.COPY)
+        self.drop_target.drag_dest_add_uri_targets()
+        self.drop_target.connect('drag-data-received', self.on_drop_received)
+        self.sw.add(self.drop_target)
+        self.drop_target.show_all()
+    
+    def on_drop_received(self, widget, context, x, y, data, info, time):
+        for uri in data.get_uris():
+            if uri.startswith('file://') and uri.endswith('.epub'):
+                self.application.load_file(urllib.unquote(uri[7:]))
+                return
+    
+    def on_book_opened(self, book_id, filename):
+        if self.destroyed:
+            self.server.release(book_id)
+            return
+        self.cancel_pagination()
+        if self.book is not None:
+            self.server.release(self.book)
+        self.book = book_id
+        self.filename = filename
+        self.server.set_viewport(self, *self._size)
+        # Monocle opens straight to the saved place.
+        uri = self.server.book_uri(book_id)
+        locus = self.application.store.position(filename)
+        if self.application.inline:
+            self.server.book_page(book_id, locus,
+                                  lambda page: self.on_book_page(book_id, page),
+                                  lambda error: self.on_book_failed(filename, error))
+        else:
+            if locus:
+                uri += '#' + urllib.quote(json.dumps(locus))
+            self.view.load_uri(uri)
+        self.open_button.hide()
+        self.settings_button.show()
+        self.toc_button.show()
+    
+    def on_book_page(self, book_id, page):
+        # The page's URL is still the book's, so its members load over HTTP.
+        if book_id == self.book:
+            self.view.load_string(page, 'text/html', 'utf-8', self.server.book_uri(book_id))
+    
+    def on_book_failed(self, filename, error):
+        if self.destroyed:
+            return
+        self.view.load_string("Could not load epub at " + filename, 'text/plain', 'utf-8',
+                              self.server.uri('/'))
     
     def on_drag_drop(self, widget, context, x, y, time, data=None):
         filename = self.view.dnd_data
@@ -134,14 +224,28 @@ class EpubReader(Gtk.ApplicationWindow):
     def on_quit(self, *args):
         self.destroy()
     
+    def on_destroy(self, *args):
+        self.destroyed = True
+        self.cancel_pagination()
+        if self._pagination_timeout is not None:
+            GObject.source_remove(self._pagination_timeout)
+            self._pagination_timeout = None
+        if self.book is not None:
+            self.server.release(self.book)
+            self.server.set_viewport(self, None)
+            self.book = None
+        if self.filename is not None:
+            self.application.store.flush()
+    
     def on_settings(self, *args):
         self.settings.show()
     
     def on_reload(self, *args):
-        self.view.reload()
+        if self.view is not None:
+            self.view.reload()
     
     def on_toc(self, *args):
-        self.view.execute_script('reader.showTOC();')
+        self.execute_script('reader.showTOC();')
     
     def on_key_press(self, widget, event):
         # Check that none of Shift, Control, Alt are pressed
@@ -160,10 +264,54 @@ class EpubReader(Gtk.ApplicationWindow):
             return
         
         self._size = (event.width, event.height)
+        if self.book is not None:
+            self.server.set_viewport(self, *self._size)
         if self._resize_timeout is not None:
             GObject.source_remove(self._resize_timeout)
-        self._resize_timeout = GObject.timeout_add(500,
-                lambda *args: self.view.execute_script('reader.resized();'))
+        self._resize_timeout = GObject.timeout_add(500, self.on_resized)
+    
+    def on_resized(self):
+        self._resize_timeout = None
+        self.execute_script('reader.resized();')
+        self.schedule_pagination()
+        return False
+    
+    def schedule_pagination(self):
+        """Look up or start working out the page counts for the current
+        layout, once it's stopped changing."""
+        if self._pagination_timeout is not None:
+            GObject.source_remove(self._pagination_timeout)
+        self._pagination_timeout = GObject.timeout_add(1000, self.update_pagination)
+    
+    def update_pagination(self):
+        self._pagination_timeout = None
+        epub = self.server.books.get(self.book) if self.book is not None else None
+        if epub is None or self.view is None:
+            return False
+        width, height = self.view.get_allocated_width(), self.view.get_allocated_height()
+        key = pagination.cache_key(epub.fingerprint, width, height, self.settings.dict)
+        if key == self.pagination_key:
+            return False
+        self.pagination_key = key
+        self.cancel_pagination()
+        data = pagination.load(key)
+        self.execute_script('setPagination(%s);' % json.dumps(data))
+        if data is None:
+            self.paginator = pagination.Paginator(self.server.book_uri(self.book), width, height,
+                                                  self.settings.styles_script(),
+                                                  lambda pages: self.on_paginated(key, pages))
+        return False
+    
+    def on_paginated(self, key, pages):
+        self.paginator = None
+        data = pagination.save(key, pages)
+        if key == self.pagination_key:
+            self.execute_script('setPagination(%s);' % json.dumps(data))
+    
+    def cancel_pagination(self):
+        if self.paginator is not None:
+            self.paginator.cancel()
+            self.paginator = None
     
     def on_title_changed(self, web_view, frame, title):
         self.set_title(title)
@@ -173,9 +321,16 @@ class EpubReader(Gtk.ApplicationWindow):
     
     def on_console_message(self, web_view, message, line, source_id):
         if message == 'Ready':
-            self.settings.update_styles()
+            self.application.mark('first page')
+            self.pagination_key = None
+            self.settings.page_loaded()
+            return True
+        if message.startswith('Position '):
+            if self.filename is not None:
+                self.application.store.set_position(self.filename,
+                                                    json.loads(message[len('Position '):]))
             return True
         return not self.application.debug
     
     def change_page(self, direction=1):
-        self.view.execute_script('reader.moveTo({direction: %i})' % direction)
+        self.execute_script('reader.moveTo({direction: %i})' % direction)
@@ -1,107 +1,583 @@
-from gi.repository import Gtk, Soup
+from gi.repository import Gtk, Soup, GObject, GLib
 import os
+import re
+import sys
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+import email.utils
 import mimetypes
 import posixpath
 import zipfile
-from xml.dom import minidom
+import zlib
+import urllib
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 import json
+import fonts
+import zipseek
+import splitter
+import bookcache
+import imagescale
+from searchindex import SearchIndex
+from assetcache import Asset, AssetCache
+from membercache import MemberCache
+from metrics import Metrics
+
+RESOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
+OPS_NS = 'http://www.idpf.org/2007/ops'
+# Good enough to find the images, styles and fonts a document uses
+LINK_RE = re.compile(r'''(?:\b(?:href|src)\s*=\s*|url\(\s*)["']?([^"'()\s>]+)''', re.I)
+# The scripts and stylesheets in index.html, for inlining
+SCRIPT_RE = re.compile(r'<script src="([^"]+)"></script>')
+STYLESHEET_RE = re.compile(r'<link rel="stylesheet" type="text/css" href="/\.([^"]+)" />')
+# /.fonts/<digest of the decoded font><extension>
+FONT_PATH_RE = re.compile(r'^/\.fonts/([0-9a-f]{40})(\.[a-z0-9]+)?$')
+# The parsed book, as embedded by optimize.py
+INDEX_MEMBER = 'META-INF/berg-index.json'
+INDEX_VERSION = 3
+
+def member_key(name):
+    """Normalize a zip member name or URL path for lookup in Epub.members."""
+    if isinstance(name, bytes):
+        try:
+            name = name.decode('utf-8')
+        except UnicodeDecodeError:
+            name = name.decode('cp437')
+    return posixpath.normpath('/' + name.replace('\\', '/')).lstrip('/')
+
+def members_digest(zfile):
+    """Identify the names, order, and contents of the members of zfile, other
+    than the embedded index, from its central directory."""
+    digest = hashlib.sha1()
+    for info in zfile.infolist():
+        if info.filename != INDEX_MEMBER:
+            line = '%s %08x %i\n' % (info.filename, info.CRC, info.file_size)
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            digest.update(line)
+    return digest.hexdigest()
+
+def member_positions(zfile):
+    """Return the position of each member of zfile in infolist(), by filename.
+    Members are stored in JSON by position, since names that aren't flagged
+    as UTF-8 are bytes, and wouldn't come back the same."""
+    return dict((info.filename, i) for i, info in enumerate(zfile.infolist()))
+
+def localname(tag):
+    return tag.rpartition('}')[2]
 
 class Epub(zipfile.ZipFile):
     
+    # Fall back to a case-insensitive match for sloppy hrefs in the OPF.
+    fold_case = True
+    # Keep the parsed OPF and member index in the user's cache directory.
+    use_cache = True
+    # Use the index embedded by optimize.py, if it matches the book.
+    use_index = True
+    # Spine documents bigger than split_threshold are served as pieces of
+    # about split_size bytes, so Monocle needn't lay out all of one at once.
+    split_threshold = 1024 * 1024
+    split_size = 256 * 1024
+    
     def __init__(self, *args):
+        self.handles = []
+        self.local = threading.local()
+        self.split_lock = threading.Lock()
+        self._splits = None
         zipfile.ZipFile.__init__(self, *args)
         self.spine = []
         self.metadata = {}
         self.contents = []
-        self.parseOPF()
+        # Path of the cover image, if the OPF names one
+        self.cover = None
+        # The book's identifiers, with the unique identifier first
+        self.identifiers = []
+        # Filename -> algorithm of the fonts that are obfuscated
+        self.obfuscated = {}
+        self._book_data = None
+        self._spine_positions = None
+        self.seek_indexes = {}
+        self.data_offsets = {}
+        # Seconds spent on each stage of opening the book
+        self.parse_times = {}
+        start = time.time()
+        self.fingerprint = bookcache.fingerprint(self)
+        self.parse_times['fingerprint'] = time.time() - start
+        
+        start = time.time()
+        cached = self.use_cache and bookcache.load(self)
+        if cached and self.restore(cached):
+            self.parse_times['cached'] = time.time() - start
+        else:
+            index = self.use_index and self.load_index()
+            if index and self.restore(index):
+                self.parse_times['index'] = time.time() - start
+            else:
+                self.index_members()
+                self.parseOPF()
+                self.parse_encryption()
+            if self.use_cache:
+                bookcache.save(self, self.snapshot())
+    
+    def snapshot(self, positions=None):
+        """Return the parsed state of the book as a JSON-able dict.  Members
+        are given by positions, from member_positions() of this book or of a
+        copy of it with the members in another order."""
+        if positions is None:
+            positions = member_positions(self)
+        return {'spine': self.spine,
+                'contents': self.contents,
+                'metadata': self.metadata,
+                'cover': self.cover,
+                'identifiers': self.identifiers,
+                'obfuscated': [[positions[name], algorithm]
+                               for name, algorithm in self.obfuscated.items()],
+                'members': dict((key, positions[info.filename])
+                                for key, info in self.members.items()),
+                'members_folded': dict((key, positions[info.filename])
+                                       for key, info in self.members_folded.items())}
+    
+    def restore(self, data):
+        """Take the parsed state of the book from a snapshot().  Returns False,
+        leaving the book unparsed, if the snapshot doesn't fit the book."""
+        infos = self.infolist()
+        try:
+            members = dict((key, infos[i]) for key, i in data['members'].items())
+            members_folded = dict((key, infos[i]) for key, i in data['members_folded'].items())
+            obfuscated = dict((infos[i].filename, algorithm)
+                              for i, algorithm in data['obfuscated'])
+            state = [data[key] for key in ('spine', 'contents', 'metadata', 'cover',
+                                           'identifiers')]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return False
+        self.spine, self.contents, self.metadata, self.cover, self.identifiers = state
+        self.members = members
+        self.members_folded = members_folded
+        self.obfuscated = obfuscated
+        return True
+    
+    def load_index(self):
+        """Return the index embedded in the book, or None if there isn't one
+        or it's out of date."""
+        if INDEX_MEMBER not in self.NameToInfo:
+            return None
+        try:
+            data = json.loads(self.read(INDEX_MEMBER).decode('utf-8'))
+        except (zipfile.BadZipfile, ValueError):
+            return None
+        if data.get('version') != INDEX_VERSION or data.get('digest') != members_digest(self):
+            return None
+        return data
+    
+    def index_members(self):
+        self.members = {}
+        self.members_folded = {}
+        for info in self.infolist():
+            if info.filename.endswith('/') or info.filename == INDEX_MEMBER:
+                continue
+            key = member_key(info.filename)
+            self.members[key] = info
+            self.members_folded.setdefault(key.lower(), info)
+        for key, info in list(self.members.items()):
+            # Some books store percent-encoded names in the archive itself.
+            self.members.setdefault(member_key(urllib.unquote(key.encode('utf-8'))), info)
+    
+    def get_member(self, path):
+        """Return the ZipInfo for a URL-encoded path, or None if it's not in the book."""
+        if isinstance(path, unicode):
+            # %-escapes are of UTF-8 bytes, so unquote the bytes.
+            path = path.encode('utf-8')
+        key = member_key(urllib.unquote(path))
+        info = self.members.get(key)
+        if info is None and self.fold_case:
+            info = self.members_folded.get(key.lower())
+        return info
+    
+    def spine_position(self, info):
+        """Return the index of info in the spine, or None if it's not there."""
+        if self._spine_positions is None:
+            self._spine_positions = {}
+            for i, href in enumerate(self.spine):
+                member = self.get_member(href)
+                if member is not None:
+                    self._spine_positions.setdefault(member.filename, i)
+        return self._spine_positions.get(info.filename)
+    
+    def linked_members(self, info, data):
+        """Return the members referenced by href, src, or url() in data, the
+        contents of info."""
+        # As a URL-encoded UTF-8 path, like the hrefs it's joined to
+        base = urllib.quote(posixpath.dirname(member_key(info.filename)).encode('utf-8'))
+        found = {}
+        for match in LINK_RE.finditer(data):
+            href = match.group(1).partition('#')[0]
+            if not href or ':' in href:
+                continue
+            member = self.get_member(posixpath.join(base, href))
+            if member is not None and member is not info:
+                found[member.filename] = member
+        return list(found.values())
+    
+    def worker_handle(self):
+        """Return the calling thread's own handle on the archive, so that
+        worker threads can read members concurrently."""
+        fp = getattr(self.local, 'fp', None)
+        if fp is None:
+            fp = self.local.fp = open(self.filename, 'rb')
+            self.handles.append(fp)
+        return fp
+    
+    def close(self):
+        for fp in self.handles:
+            fp.close()
+        del self.handles[:]
+        zipfile.ZipFile.close(self)
+    
+    def read_range(self, info, start, length):
+        """Read length bytes of info, beginning at start, with the calling
+        thread's handle.  Whole members are checked against their CRC, as
+        ZipFile.read would."""
+        f = self.open_range(info, start, length, self.worker_handle())
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if start == 0 and length == info.file_size and zlib.crc32(data) & 0xffffffff != info.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %r" % info.filename)
+        return data
+    
+    def open_range(self, info, start, length, fp=None):
+        """Return a file-like object for length bytes of info, beginning at start.
+        
+        Stored members are read directly from the archive, while deflated ones
+        are inflated from the nearest point in a SeekIndex built on first use.
+        If fp is given, it is used to read the archive and is left open.
+        """
+        if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED,
+                                                              zipfile.ZIP_DEFLATED):
+            f = self.open(info, 'r')
+            while start:
+                start -= len(f.read(min(start, zipseek.InflateReader.block_size)))
+            return zipseek.LimitedReader(f, length)
+        
+        owned = fp is None
+        if owned:
+            fp = open(self.filename, 'rb')
+        offset = self.data_offsets.get(info.filename)
+        if offset is None:
+            offset = self.data_offsets[info.filename] = zipseek.data_offset(fp, info)
+        if info.compress_type == zipfile.ZIP_STORED:
+            fp.seek(offset + start)
+            return zipseek.LimitedReader(fp, length, owned)
+        
+        if start == 0:
+            return zipseek.InflateReader(fp, offset, info.compress_size, zipseek.start_point(),
+                                         0, length, owned)
+        index = self.seek_indexes.get(info.filename)
+        if index is None:
+            # Built without a lock, since it inflates the whole member.  Two
+            # threads may both build one; the first to finish is kept.
+            index = self.seek_indexes.setdefault(info.filename,
+                                                 zipseek.SeekIndex(fp, offset, info))
+        return index.open(fp, offset, start, length, owned)
+    
+    def iterparse(self, name, events=('start', 'end')):
+        """Iterate over (event, element, local name) for the XML member name.
+        Elements are cleared after their end event."""
+        f = self.open(name, 'r')
+        try:
+            for event, elem in ElementTree.iterparse(f, events):
+                yield event, elem, localname(elem.tag)
+                if event == 'end':
+                    elem.clear()
+        finally:
+            f.close()
     
     def parseOPF(self):
-        container = minidom.parseString(self.read('META-INF/container.xml'))
+        start = time.time()
         contentsfn = None
-        for rootfile in container.getElementsByTagName('rootfile'):
-            if rootfile.getAttribute('media-type') == "application/oebps-package+xml":
-                contentsfn = rootfile.getAttribute('full-path')
+        for event, elem, name in self.iterparse('META-INF/container.xml', ('end',)):
+            if (name == 'rootfile' and
+                    elem.get('media-type') == "application/oebps-package+xml"):
+                contentsfn = elem.get('full-path')
                 break
         if not contentsfn:
-            raise zipfile.BadZipFile("Could not find contents file")
+            raise zipfile.BadZipfile("Could not find contents file")
         contentsdir, _, _ = contentsfn.rpartition('/')
         if contentsdir:
             contentsdir += '/'
         
         idmap = {}
-        contents = minidom.parseString(self.read(contentsfn))
-        manifest = contents.getElementsByTagName('manifest')[0]
+        idrefs = []
         nav_href = None
-        for item in manifest.getElementsByTagName('item'):
-            idmap[item.getAttribute('id')] = contentsdir + item.getAttribute('href')
-            if 'nav' in item.getAttribute('properties').split(' '):
-                nav_href = idmap[item.getAttribute('id')]
-        spine = contents.getElementsByTagName('spine')[0]
-        for item in spine.getElementsByTagName('itemref'):
-            self.spine.append(idmap[item.getAttribute('idref')])
-        metadata = contents.getElementsByTagName('metadata')[0]
-        for node in metadata.childNodes:
-            if node.nodeType is minidom.Node.ELEMENT_NODE:
-                try:
-                    self.metadata[node.localName] = node.firstChild.nodeValue
-                except AttributeError:
-                    pass
+        toc_id = None
+        cover_id = None
+        unique_id = None
+        seen = set()
+        section = None
+        depth = section_depth = 0
+        for event, elem, name in self.iterparse(contentsfn):
+            if event == 'start':
+                depth += 1
+                if depth == 1 and name == 'package':
+                    unique_id = elem.get('unique-identifier')
+                elif section is None and name in ('manifest', 'spine', 'metadata') and name not in seen:
+                    section, section_depth = name, depth
+                    seen.add(name)
+                    if name == 'spine':
+                        toc_id = elem.get('toc')
+                elif section == 'manifest' and name == 'item':
+                    idmap[elem.get('id', '')] = contentsdir + elem.get('href', '')
+                    properties = elem.get('properties', '').split(' ')
+                    if 'nav' in properties:
+                        nav_href = idmap[elem.get('id', '')]
+                    if 'cover-image' in properties:  # EPUB 3
+                        self.cover = idmap[elem.get('id', '')]
+                elif section == 'metadata' and name == 'meta' and elem.get('name') == 'cover':
+                    cover_id = elem.get('content')  # EPUB 2
+                elif section == 'spine' and name == 'itemref':
+                    idrefs.append(elem.get('idref', ''))
+                continue
+            
+            if section == 'metadata' and depth == section_depth + 1:
+                # Mimic the text of the element's first child node
+                if elem.text is not None:
+                    self.metadata[name] = elem.text
+                elif len(elem):
+                    self.metadata[name] = None
+                if name == 'identifier' and elem.text:
+                    if unique_id is not None and elem.get('id') == unique_id:
+                        self.identifiers.insert(0, elem.text)
+                    else:
+                        self.identifiers.append(elem.text)
+            elif depth == section_depth and name == section:
+                section = None
+            depth -= 1
+        
+        self.spine = [idmap[idref] for idref in idrefs]
+        if self.cover is None and cover_id in idmap:
+            self.cover = idmap[cover_id]
+        self.parse_times['opf'] = time.time() - start
+        
+        start = time.time()
         if nav_href:  # EPUB 3
             self.parse_nav(nav_href)
-        else:
-            try:  # EPUB 2
-                self.parse_NCX(idmap[spine.getAttribute('toc')])
+            self.parse_times['nav'] = time.time() - start
+        elif toc_id is not None:  # EPUB 2
+            try:
+                self.parse_NCX(idmap[toc_id])
             except KeyError:
                 pass
+            self.parse_times['ncx'] = time.time() - start
+    
+    def parse_encryption(self):
+        """Note the fonts that META-INF/encryption.xml says are obfuscated
+        with an algorithm we can undo."""
+        if 'META-INF/encryption.xml' not in self.NameToInfo:
+            return
+        algorithm = None
+        try:
+            for event, elem, name in self.iterparse('META-INF/encryption.xml', ('start',)):
+                if name == 'EncryptedData':
+                    algorithm = None
+                elif name == 'EncryptionMethod':
+                    algorithm = elem.get('Algorithm')
+                elif name == 'CipherReference' and algorithm in fonts.OBFUSCATED_LENGTH:
+                    info = self.get_member(elem.get('URI', ''))
+                    if info is not None:
+                        self.obfuscated[info.filename] = algorithm
+        except ElementTree.ParseError:
+            pass
     
     def parse_nav(self, navfile):
         self.navdir, _, _ = navfile.rpartition('/')
         if self.navdir:
             self.navdir += '/'
-        navdoc = minidom.parseString(self.read(navfile))
-        for nav in navdoc.getElementsByTagName('nav'):
-            if nav.getAttribute('epub:type') == 'toc':
-                self.contents = self.parse_nav_list(nav.getElementsByTagName('ol')[0])
-    
-    def parse_nav_list(self, element):
-        children = []
-        for item in element.childNodes:
-            if item.nodeType is minidom.Node.ELEMENT_NODE and item.nodeName == 'li':
-                try:
-                    link = item.getElementsByTagName('a')[0]
-                except IndexError:
-                    continue
-                children.append({'title': link.firstChild.nodeValue,
-                                 'src': self.navdir + link.getAttribute('href')})
-                olist = item.getElementsByTagName('ol')
-                if olist:
-                    children[-1]['children'] = self.parse_nav_list(olist[0])
-        return children
+        
+        # Each li takes the first a and ol inside it, and only the li children
+        # of those ols (or of the first ol in the nav) become entries.
+        stack = []
+        toc = None
+        for event, elem, name in self.iterparse(navfile):
+            if event == 'start':
+                frame = {}
+                if name == 'nav' and toc is None and (elem.get('{%s}type' % OPS_NS) == 'toc' or
+                                                      elem.get('epub:type') == 'toc'):
+                    toc = frame
+                    frame['ol'] = None
+                elif toc is not None and name == 'ol':
+                    owners = [f for f in stack if 'ol' in f and f['ol'] is None]
+                    if owners:
+                        frame['entries'] = []
+                        for owner in owners:
+                            owner['ol'] = frame['entries']
+                elif toc is not None and name == 'li' and 'entries' in stack[-1]:
+                    frame.update(link=None, ol=None)
+                stack.append(frame)
+                continue
+            
+            frame = stack.pop()
+            if toc is None:
+                continue
+            if name == 'a':
+                for owner in stack:
+                    if 'link' in owner and owner['link'] is None:
+                        owner['link'] = (elem.text, elem.get('href', ''))
+            elif frame is toc:
+                if toc['ol'] is not None:
+                    self.contents = toc['ol']
+                toc = None
+            elif frame.get('link') is not None:
+                entry = {'title': frame['link'][0], 'src': self.navdir + frame['link'][1]}
+                if frame['ol'] is not None:
+                    entry['children'] = frame['ol']
+                stack[-1]['entries'].append(entry)
     
     def parse_NCX(self, ncxfile):
         self.navdir, _, _ = ncxfile.rpartition('/')
         if self.navdir:
             self.navdir += '/'
-        ncx = minidom.parseString(self.read(ncxfile))
-        navmap = ncx.getElementsByTagName('navMap')[0]
-        self.contents = self.parse_NCX_children(navmap)
-    
-    def parse_NCX_children(self, element):
-        children = []
-        for node in element.childNodes:
-            if node.nodeType is minidom.Node.ELEMENT_NODE and node.nodeName == 'navPoint':
-                children.append({})
-                nav_label = node.getElementsByTagName('text')[0]
-                children[-1]['title'] = nav_label.firstChild.nodeValue
-                content = node.getElementsByTagName('content')[0]
-                children[-1]['src'] = self.navdir + content.getAttribute('src')
-                child_nav = self.parse_NCX_children(node)
-                if child_nav:
-                    children[-1]['children'] = child_nav
-        return children
+        
+        # Each navPoint takes its title and src from the first text and
+        # content elements inside it.
+        stack = []
+        in_navmap = False
+        for event, elem, name in self.iterparse(ncxfile):
+            if name == 'navMap':
+                if event == 'start' and not in_navmap and not self.contents:
+                    in_navmap = True
+                    stack.append({'children': self.contents})
+                elif event == 'end' and in_navmap and len(stack) == 1:
+                    in_navmap = False
+                    stack.pop()
+            elif not in_navmap:
+                continue
+            elif name == 'navPoint':
+                if event == 'start':
+                    stack.append({'children': []})
+                else:
+                    entry = stack.pop()
+                    if not entry['children']:
+                        del entry['children']
+                    stack[-1]['children'].append(entry)
+            elif name == 'text' and event == 'end':
+                for entry in stack[1:]:
+                    entry.setdefault('title', elem.text)
+            elif name == 'content' and event == 'start':
+                for entry in stack[1:]:
+                    entry.setdefault('src', self.navdir + elem.get('src', ''))
     
     @property
     def book_data(self):
+        if self._book_data is None:
+            self._book_data = self.make_book_data()
+        return self._book_data
+    
+    def splits(self):
+        """Return how each oversized spine document is split, keyed by its
+        filename, working it out or loading it from the cache on first use."""
+        with self.split_lock:
+            if self._splits is not None:
+                return self._splits
+            sizes = [self.split_threshold, self.split_size]
+            cached = self.use_cache and bookcache.load(self, '.split.json')
+            if cached and cached['sizes'] == sizes:
+                infos = self.infolist()
+                self._splits = dict((infos[i].filename, split) for i, split in cached['splits'])
+                return self._splits
+            
+            start = time.time()
+            self._splits = {}
+            for href in self.spine:
+                info = self.get_member(href)
+                if (info is None or info.file_size <= self.split_threshold or
+                        info.filename in self._splits):
+                    continue
+                split = splitter.split(self.read_range(info, 0, info.file_size), self.split_size)
+                if split is not None:
+                    self._splits[info.filename] = split
+            self.parse_times['split'] = time.time() - start
+            if self.use_cache:
+                positions = member_positions(self)
+                bookcache.save(self, {'sizes': sizes,
+                                      'splits': [[positions[name], split]
+                                                 for name, split in self._splits.items()]},
+                               '.split.json')
+            return self._splits
+    
+    def components(self):
+        """Return the spine, with the split documents replaced by their pieces."""
+        splits = self.splits()
+        components = []
+        for href in self.spine:
+            info = self.get_member(href)
+            split = info is not None and splits.get(info.filename)
+            if split:
+                components.extend(splitter.piece_href(href, i)
+                                  for i in range(len(split['pieces'])))
+            else:
+                components.append(href)
+        return components
+    
+    def get_piece(self, path):
+        """Return the ZipInfo of the split document and the index of the
+        piece for a URL-encoded path from components(), or None."""
+        document, tilde, index = path.rpartition('~')
+        if not tilde or not index.isdigit():
+            return None
+        info = self.get_member(document)
+        split = info is not None and self.splits().get(info.filename)
+        if not split or int(index) >= len(split['pieces']):
+            return None
+        return info, int(index)
+    
+    def read_piece(self, info, index):
+        """Return a piece of the split document info, as a document of its own."""
+        split = self.splits()[info.filename]
+        start, end = split['pieces'][index][:2]
+        name = posixpath.basename(info.filename)
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return splitter.assemble(self.read_range(info, 0, split['head']),
+                                 self.read_range(info, start, end - start),
+                                 split, index, urllib.quote(name))
+    
+    def read_component(self, href):
+        """Return the document at href in components(), or None."""
+        info = self.get_member(href)
+        if info is not None:
+            return self.read_range(info, 0, info.file_size)
+        piece = self.get_piece(href)
+        if piece is not None:
+            return self.read_piece(*piece)
+        return None
+    
+    def split_contents(self, entries):
+        """Return the table of contents entries, pointing into the pieces of
+        the split documents."""
+        splits = self.splits()
+        result = []
+        for entry in entries:
+            entry = dict(entry)
+            src = entry.get('src')
+            if src:
+                href, hash, fragment = src.partition('#')
+                info = self.get_member(href)
+                split = info is not None and splits.get(info.filename)
+                if split:
+                    key = urllib.unquote(fragment.encode('utf-8')).decode('utf-8', 'replace')
+                    piece = split['ids'].get(key, 0)
+                    entry['src'] = splitter.piece_href(href, piece) + hash + fragment
+            if 'children' in entry:
+                entry['children'] = self.split_contents(entry['children'])
+            result.append(entry)
+        return result
+    
+    def make_book_data(self):
         return '''{
             getComponents: function () {
                 return %s;
@@ -115,84 +591,729 @@ class Epub(zipfile.ZipFile):
             getMetaData: function (key) {
                 return %s[key];
             }
-        }''' % (json.dumps(self.spine), json.dumps(self.contents), json.dumps(self.metadata))
+        }''' % (json.dumps(self.components()), json.dumps(self.split_contents(self.contents)),
+               json.dumps(self.metadata))
 
 
 class EpubServer(Soup.Server):
     
+    # Members bigger than this are streamed in blocks of chunk_size, rather
+    # than being inflated into memory all at once.
+    stream_threshold = 1024 * 1024
+    chunk_size = 64 * 1024
+    # Lifetime of the bundled scripts and styles in WebKit's cache.  Book
+    # URLs contain the book's fingerprint, so they can be kept much longer.
+    static_max_age = 3600
+    book_max_age = 7 * 24 * 3600
+    # Memory for decompressed members, shared by all books
+    member_cache_size = 32 * 1024 * 1024
+    # Threads for reading and parsing books off the main loop
+    workers = 4
+    # Build each book's search index in the background as soon as it's opened,
+    # rather than on its first search
+    index_on_open = False
+    # JPEGs and PNGs larger than the biggest viewport are scaled down to fit
+    # it, rounded up to a multiple of image_step pixels.  ?original gets the
+    # image as it is in the book.
+    scale_images = True
+    image_step = 256
+    # Decoded fonts are served from /.fonts/ under the digest of their
+    # contents, so WebKit can keep one copy of each for as long as it likes.
+    font_max_age = 365 * 24 * 3600
+    # Shared by all servers in the process
+    assets = None
+    pool = None
+    
     def __init__(self, *args, **kw):
         """Arguments are passed to Soup.Server."""
         Soup.Server.__init__(self, *args, **kw)
-        self.epub = None
+        self.books = {}
+        self.book_ids = {}
+        self.refcounts = {}
+        self.book_payloads = {}
+        self.deferred = {}
+        self.member_cache = MemberCache(self.member_cache_size)
+        self.prefetching = set()
+        self.search_indexes = {}
+        self.viewports = {}
+        # (book id, member) -> digest of the decoded font
+        self.font_digests = {}
+        # (book id, member, box) of images that needn't or can't be scaled
+        self.unscalable = set()
+        # book id -> callbacks waiting for its search index
+        self.indexing = {}
+        self.metrics = Metrics()
+        self.started = time.time()
+        # Write a JSON line describing each request to stderr
+        self.trace = False
+        if EpubServer.assets is None:
+            EpubServer.assets = AssetCache(RESOURCE_DIR, self.guess_type)
+        if EpubServer.pool is None:
+            GObject.threads_init()
+            EpubServer.pool = ThreadPool(self.workers)
+            # Once a run, keep the disk caches in bounds.
+            self.background(bookcache.prune, lambda result: None, lambda error: None)
         
-        self.add_handler('/.bookdata.js', self.book_data)
+        self.add_handler('/book/', self.book)
+        self.add_handler('/.metrics', self.serve_metrics)
+        self.add_handler('/.fonts/', self.font)
         self.add_handler('/.application-menu', self.app_menu_icon)
         self.add_handler('/.', self.static)
         self.add_handler('/', self.root)
         
         self.run_async()
     
-    def book_data(self, server, message, path, query, client):
-        if not self.epub:
+    def uri(self, path):
+        return 'http://localhost:%i%s' % (self.get_port(), path)
+    
+    def book_uri(self, book_id):
+        return self.uri('/book/%s/' % book_id)
+    
+    def background(self, work, done, failed, *args):
+        """Run work(*args) in the worker pool.  Back on the main loop, pass
+        the result to done, or the exception to failed."""
+        def finish(result, error):
+            if error is None:
+                done(result)
+            else:
+                failed(error)
+            return False
+        
+        def run():
+            try:
+                result = (work(*args), None)
+            except Exception as error:
+                result = (None, error)
+            GLib.idle_add(finish, *result)
+        
+        self.pool.apply_async(run)
+    
+    def defer(self, message, work, done, *args, **kw):
+        """Pause message while work(*args) runs in the background, then pass
+        the result to done, or the exception to failed, and resume the message
+        once nothing else is pending for it."""
+        failed = kw.get('failed', self.failed)
+        self.deferred[message] = self.deferred.get(message, 0) + 1
+        self.pause_message(message)
+        
+        def finish(callback, value):
+            self.deferred[message] -= 1
+            callback(value)
+            if not self.deferred[message]:
+                del self.deferred[message]
+                self.unpause_message(message)
+        
+        self.background(work, lambda result: finish(done, result),
+                        lambda error: finish(lambda error: failed(message, error), error), *args)
+    
+    def track(self, message, handler, path, book_id=None):
+        """Record the handler's latency and response size once message is
+        finished, and trace the request if asked to."""
+        start = time.time()
+        
+        def finished(message):
+            message.disconnect(finished_id)
+            elapsed = (time.time() - start) * 1000
+            nbytes = message.response_headers.get_content_length()
+            self.metrics.record_request(handler, message.status_code, nbytes, elapsed)
+            if self.trace:
+                sys.stderr.write(json.dumps({'time': start, 'handler': handler, 'book': book_id,
+                                             'path': path, 'status': message.status_code,
+                                             'bytes': nbytes, 'ms': round(elapsed, 3)}) + '\n')
+        
+        finished_id = message.connect('finished', finished)
+    
+    def serve_metrics(self, server, message, path, query, client):
+        data = self.metrics.as_dict()
+        data.update(uptime=time.time() - self.started,
+                    member_cache=self.member_cache.stats(),
+                    books=dict((book_id, {'path': path, 'refcount': self.refcounts[book_id]})
+                               for path, book_id in self.book_ids.items()))
+        message.set_status(Soup.Status.OK)
+        message.response_headers.replace('Cache-Control', 'no-cache')
+        message.set_response('application/json', Soup.MemoryUse.COPY,
+                             json.dumps(data, indent=2, sort_keys=True))
+    
+    def open_book(self, path, done, failed):
+        """Open the epub at path, or take another reference to it if it's
+        already open, and pass its id to done.  Each call must be matched by
+        a call to release once the book is no longer needed."""
+        path = os.path.abspath(path)
+        book_id = self.book_ids.get(path)
+        if book_id is not None:
+            self.refcounts[book_id] += 1
+            return done(book_id)
+        self.background(Epub, lambda epub: done(self.add_book(path, epub)), failed, path, 'r')
+    
+    def add_book(self, path, epub):
+        book_id = epub.fingerprint[:16]
+        if book_id in self.books:  # Opened twice at once
+            epub.close()
+        else:
+            self.books[book_id] = epub
+            self.book_ids[path] = book_id
+            self.refcounts[book_id] = 0
+            for stage, seconds in epub.parse_times.items():
+                self.metrics.record_time('open_' + stage, seconds * 1000)
+            if self.index_on_open:
+                self.search_index(book_id, epub, lambda index: None, lambda error: None)
+        self.refcounts[book_id] += 1
+        return book_id
+    
+    def release(self, book_id):
+        """Drop a reference taken by open_book, closing the book with the last one."""
+        self.refcounts[book_id] -= 1
+        if self.refcounts[book_id] <= 0:
+            epub = self.books.pop(book_id)
+            del self.refcounts[book_id]
+            self.book_payloads.pop(book_id, None)
+            self.search_indexes.pop(book_id, None)
+            self.member_cache.discard((book_id,))
+            self.unscalable = set(key for key in self.unscalable if key[0] != book_id)
+            for key in [key for key in self.font_digests if key[0] == book_id]:
+                del self.font_digests[key]
+            for path, path_id in list(self.book_ids.items()):
+                if path_id == book_id:
+                    del self.book_ids[path]
+            epub.close()
+    
+    def failed(self, message, error):
+        message.set_status(Soup.Status.INTERNAL_SERVER_ERROR)
+        message.set_response('text/plain', Soup.MemoryUse.COPY, str(error))
+    
+    def book(self, server, message, path, query, client):
+        book_id, slash, member = path[len('/book/'):].partition('/')
+        epub = self.books.get(book_id)
+        if epub is None:
+            self.track(message, 'book', path)
             message.set_status(Soup.Status.NOT_FOUND)
+        elif not slash:
+            self.track(message, 'book', path)
+            message.set_status(Soup.Status.MOVED_PERMANENTLY)
+            message.response_headers.replace('Location', '/book/%s/' % book_id)
+        elif member == '':
+            self.track(message, 'index', path, book_id)
+            self.serve_resource(message, 'index.html')
+        elif member == '.bookdata.js':
+            self.track(message, 'book_data', path, book_id)
+            self.book_data(message, book_id, epub)
+        elif member == '.search':
+            self.track(message, 'search', path, book_id)
+            self.search(message, book_id, epub, query or {})
+        else:
+            self.track(message, 'from_epub', member, book_id)
+            info = epub.get_member(member)
+            if info is not None:
+                return self.from_epub(message, book_id, epub, info, query)
+            if '~' in member:
+                return self.from_piece(message, book_id, epub, member)
+            message.set_status(Soup.Status.NOT_FOUND)
+    
+    def book_data(self, message, book_id, epub):
+        payload = self.book_payloads.get(book_id)
+        if payload is None:
+            return self.defer(message, self.make_book_payload, self.got_book_payload,
+                              message, book_id, epub)
+        self.send_asset(message, payload, self.book_max_age)
+    
+    def make_book_payload(self, message, book_id, epub):
+        payload = Asset(("var bookData = %s" % epub.book_data).encode('utf-8'),
+                        'application/javascript', time.time())
+        return message, book_id, payload
+    
+    def got_book_payload(self, result):
+        message, book_id, payload = result
+        if book_id in self.books:
+            self.book_payloads[book_id] = payload
+        self.send_asset(message, payload, self.book_max_age)
+    
+    def search_index(self, book_id, epub, done, failed):
+        """Pass the search index for the book to done, building it in the
+        background if need be."""
+        index = self.search_indexes.get(book_id)
+        if index is not None:
+            return done(index)
+        waiting = self.indexing.get(book_id)
+        if waiting is not None:
+            return waiting.append((done, failed))
+        self.indexing[book_id] = [(done, failed)]
+        self.background(self.build_search_index, lambda index: self.indexed(book_id, index),
+                        lambda error: self.indexed(book_id, None, error), epub)
+    
+    def build_search_index(self, epub):
+        start = time.time()
+        index = SearchIndex.for_book(epub)
+        self.metrics.record_time('search_index', (time.time() - start) * 1000)
+        return index
+    
+    def indexed(self, book_id, index, error=None):
+        if index is not None and book_id in self.books:
+            self.search_indexes[book_id] = index
+        for done, failed in self.indexing.pop(book_id):
+            if index is not None:
+                done(index)
+            else:
+                failed(error)
+    
+    def search(self, message, book_id, epub, query):
+        """Answer ?q=words[&limit=n] with the best hits in the book as JSON."""
+        words = query.get('q', '').decode('utf-8', 'replace').strip()
+        try:
+            limit = max(1, min(int(query.get('limit', 20)), 1000))
+        except ValueError:
+            limit = 0
+        if not words or not limit:
+            message.set_status(Soup.Status.BAD_REQUEST)
             return
         
-        message.set_status(Soup.Status.OK)
-        message.set_response('application/javascript', Soup.MemoryUse.COPY,
-            "var bookData = %s" % self.epub.book_data)
+        def respond(hits):
+            message.set_status(Soup.Status.OK)
+            message.response_headers.replace('Cache-Control', 'no-cache')
+            message.set_response('application/json', Soup.MemoryUse.COPY,
+                                 json.dumps({'query': words, 'hits': hits}))
+        
+        def done(index):
+            # In the background, since the snippets are read from the book
+            self.defer(message, self.query_index, respond, index, words, limit)
+        
+        if book_id in self.search_indexes:
+            return done(self.search_indexes[book_id])
+        # Wait for the index to be built.  The query keeps the message paused.
+        self.pause_message(message)
+        
+        def failed(error):
+            self.failed(message, error)
+            self.unpause_message(message)
+        
+        self.search_index(book_id, epub, done, failed)
+    
+    def query_index(self, index, words, limit):
+        start = time.time()
+        hits = index.search(words, limit)
+        self.metrics.record_time('search_query', (time.time() - start) * 1000)
+        return hits
+    
+    def book_page(self, book_id, locus, done, failed):
+        """Pass done the reader page for the book, with its scripts, styles
+        and book data inlined, opening at locus if it's given.  A WebView in
+        this process can show it with load_string, so that only the book's
+        own members are fetched over HTTP.  WebKit can't cache the inlined
+        scripts between windows, though, so readers only do this with --inline."""
+        self.background(self.make_book_page, done, failed, self.books[book_id], locus)
+    
+    def make_book_page(self, epub, locus):
+        began = time.time()
+        
+        def script(match):
+            src = match.group(1)
+            if src == '.bookdata.js':
+                data = 'var bookData = %s;' % epub.book_data
+                if locus:
+                    data += '\nvar initialPlace = %s;' % json.dumps(locus)
+            else:
+                data = self.assets.get(src[2:]).data
+            return '<script>%s</script>' % data.replace('</', '<\\/')
+        
+        def stylesheet(match):
+            return '<style type="text/css">%s</style>' % self.assets.get(match.group(1)).data
+        
+        page = SCRIPT_RE.sub(script, self.assets.get('index.html').data)
+        page = STYLESHEET_RE.sub(stylesheet, page)
+        self.metrics.record_time('book_page', (time.time() - began) * 1000, len(page))
+        return page
     
     def app_menu_icon(self, server, message, path, query, client):
+        self.track(message, 'serve_resource', path)
         icon = Gtk.IconTheme.get_default().lookup_icon('emblem-system', 20, 0)
         self.serve_resource(message, icon.get_filename())
     
     def static(self, server, message, path, query, client):
-        self.serve_resource(message, path[2:])
+        self.track(message, 'serve_resource', path)
+        self.serve_resource(message, path[2:], self.static_max_age)
     
-    def serve_resource(self, message, path):
-        resource_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
-        try:
-            f = open(os.path.join(resource_dir, path), 'rb')
-        except IOError:
+    def serve_resource(self, message, path, max_age=0):
+        asset = self.assets.get(path)
+        if asset is None:
             message.set_status(Soup.Status.NOT_FOUND)
             return
-        
+        self.send_asset(message, asset, max_age)
+    
+    def send_asset(self, message, asset, max_age=0):
+        body, etag = asset.data, asset.etag
+        if asset.gzipped is not None:
+            message.response_headers.append('Vary', 'Accept-Encoding')
+            if Soup.header_contains(message.request_headers.get_one('Accept-Encoding') or '', 'gzip'):
+                body, etag = asset.gzipped, asset.etag[:-1] + '-gzip"'
+                message.response_headers.replace('Content-Encoding', 'gzip')
+        if self.not_modified(message, etag, asset.mtime, max_age):
+            return
         message.set_status(Soup.Status.OK)
-        message.set_response(self.guess_type(path), Soup.MemoryUse.COPY, f.read())
+        message.set_response(asset.content_type, Soup.MemoryUse.COPY, body)
     
     def root(self, server, message, path, query, client):
-        if path == '/':
-            return self.index(message, query)
-        if self.epub is None:
+        self.track(message, 'root', path)
+        if path != '/':
+            message.set_status(Soup.Status.NOT_FOUND)
+            return
+        
+        # For debugging in a browser: the book stays open as long as the server.
+        epub_path = query and query.get('load')
+        if epub_path:
+            self.pause_message(message)
+            return self.open_book(epub_path, lambda book_id: self.loaded(message, book_id),
+                                  lambda error: self.load_failed(message, error, epub_path))
+        self.serve_resource(message, 'load.html')
+    
+    def loaded(self, message, book_id):
+        message.set_status(Soup.Status.FOUND)
+        message.response_headers.replace('Location', '/book/%s/' % book_id)
+        self.unpause_message(message)
+    
+    def load_failed(self, message, error, epub_path):
+        if isinstance(error, (IOError, zipfile.BadZipfile, ElementTree.ParseError)):
             message.set_status(Soup.Status.INTERNAL_SERVER_ERROR)
+            message.set_response('text/plain', Soup.MemoryUse.COPY,
+                "Could not load epub at " + epub_path)
+        else:
+            self.failed(message, error)
+        self.unpause_message(message)
+    
+    def set_viewport(self, owner, width, height=None):
+        """Note the size of owner's view, for scaling images to.  A width of
+        None, or an empty size, forgets it."""
+        if not width or not height:
+            self.viewports.pop(owner, None)
+        else:
+            self.viewports[owner] = (width, height)
+    
+    def image_box(self):
+        """Return the size that images are scaled down to fit, or None."""
+        if not self.scale_images or not self.viewports:
+            return None
+        step = self.image_step
+        return tuple(-(-max(sizes) // step) * step for sizes in zip(*self.viewports.values()))
+    
+    def from_epub(self, message, book_id, epub, info, query=None):
+        if info.filename in epub.obfuscated:
+            return self.from_font(message, book_id, epub, info)
+        box = self.image_box()
+        if (box is not None and 'original' not in (query or {}) and
+                self.guess_type(info.filename) in imagescale.SCALABLE and
+                message.request_headers.get_one('Range') is None and
+                (book_id, info.filename, box) not in self.unscalable):
+            return self.scaled_image(message, book_id, epub, info, box)
+        
+        message.response_headers.replace('Accept-Ranges', 'bytes')
+        if self.not_modified(message, '"%08x-%x"' % (info.CRC, info.file_size),
+                             time.mktime(info.date_time + (0, 0, -1)), self.book_max_age):
+            return
+        try:
+            byte_range = zipseek.parse_range(message.request_headers.get_one('Range'),
+                                             info.file_size)
+        except ValueError:
+            message.set_status(Soup.Status.REQUESTED_RANGE_NOT_SATISFIABLE)
+            message.response_headers.replace('Content-Range', 'bytes */%i' % info.file_size)
             return
-        if path[1:] in self.epub.namelist():
-            return self.from_epub(message, path[1:])
-        message.set_status(Soup.Status.NOT_FOUND)
+        
+        if byte_range is None:
+            message.set_status(Soup.Status.OK)
+            start, length = 0, info.file_size
+        else:
+            start, end = byte_range
+            length = end - start + 1
+            message.set_status(Soup.Status.PARTIAL_CONTENT)
+            message.response_headers.set_content_range(start, end, info.file_size)
+        
+        content_type = self.guess_type(info.filename)
+        if length > self.stream_threshold:
+            return self.defer(message, epub.open_range,
+                              lambda f: self.stream_response(message, content_type, f, length),
+                              info, start, length)
+        
+        if info.file_size > self.stream_threshold:
+            return self.defer(message, self.read_range,
+                              lambda data: message.set_response(content_type,
+                                                                Soup.MemoryUse.COPY, data),
+                              epub, info, start, length)
+        
+        def respond(data):
+            message.set_response(content_type, Soup.MemoryUse.COPY, data[start:start + length])
+        
+        data = self.member_cache.get((book_id, info.filename))
+        if data is None:
+            self.defer(message, self.read_member, respond, book_id, epub, info)
+        else:
+            respond(data)
+        self.prefetch_neighbours(book_id, epub, info)
     
-    def index(self, message, query):
-        epub_path = query.get('load')
-        if epub_path:
-            if self.epub is not None:
-                self.epub.close()
-            try:
-                self.epub = Epub(epub_path, 'r')
-            except (IOError, zipfile.BadZipfile):
-                message.set_status(Soup.Status.INTERNAL_SERVER_ERROR)
-                message.set_response('text/plain', Soup.MemoryUse.COPY,
-                    "Could not load epub at " + epub_path)
-                self.epub = None
+    def from_font(self, message, book_id, epub, info):
+        """Redirect to the decoded copy of an obfuscated font.  Decoded fonts
+        are kept on disk, in memory, and in WebKit's cache under the digest
+        of their contents, so a font shared by several books is only decoded
+        and held once."""
+        key = (book_id, info.filename)
+        ext = posixpath.splitext(info.filename)[1].lower()
+        
+        def redirect(digest):
+            message.set_status(Soup.Status.FOUND)
+            message.response_headers.replace('Location', '/.fonts/%s%s' % (digest, ext))
+            message.response_headers.replace('Cache-Control', 'max-age=%i' % self.book_max_age)
+        
+        def respond(result):
+            if result is None:  # No identifier to decode it with
+                message.set_status(Soup.Status.NOT_FOUND)
                 return
+            digest, data = result
+            if book_id in self.books:
+                self.font_digests[key] = digest
+            self.member_cache.put(('fonts', digest), data)
+            redirect(digest)
         
-        if self.epub:
-            self.serve_resource(message, 'index.html')
-        else:
-            self.serve_resource(message, 'load.html')
+        digest = self.font_digests.get(key)
+        if digest is not None:
+            return redirect(digest)
+        self.defer(message, self.load_font, respond, epub, info)
     
-    def from_epub(self, message, path):
-        info = self.epub.getinfo(path)
-        message.set_status(Soup.Status.OK)
-        f = self.epub.open(info, 'r')
-        message.set_response(self.guess_type(path), Soup.MemoryUse.COPY, f.read())
+    def font(self, server, message, path, query, client):
+        self.track(message, 'font', path)
+        match = FONT_PATH_RE.match(path)
+        if match is None:
+            message.set_status(Soup.Status.NOT_FOUND)
+            return
+        digest = match.group(1)
+        # The contents never change, so any copy the client has is current.
+        if self.not_modified(message, '"%s"' % digest, 0, self.font_max_age):
+            return
+        
+        def respond(data):
+            if data is None:
+                message.set_status(Soup.Status.NOT_FOUND)
+                return
+            message.set_status(Soup.Status.OK)
+            message.set_response(self.guess_type(path), Soup.MemoryUse.COPY, data)
+        
+        data = self.member_cache.get(('fonts', digest))
+        if data is not None:
+            return respond(data)
+        self.defer(message, self.read_font, respond, digest)
+    
+    def read_font(self, digest):
+        data = fonts.read(digest)
+        if data is not None:
+            self.member_cache.put(('fonts', digest), data)
+        return data
+    
+    def load_font(self, epub, info):
+        """Return the digest and data of the decoded font info, from the
+        disk cache if it's been decoded before, or None if it can't be."""
+        algorithm = epub.obfuscated[info.filename]
+        key = fonts.font_key(algorithm, epub.identifiers)
+        if key is None:
+            return None
+        cached = fonts.load(info, algorithm, key)
+        if cached is not None:
+            return cached
+        began = time.time()
+        data = fonts.deobfuscate(epub.read_range(info, 0, info.file_size), algorithm, key)
+        digest = fonts.save(info, algorithm, key, data)
+        self.metrics.record_time('deobfuscate', (time.time() - began) * 1000, len(data))
+        return digest, data
+    
+    def from_piece(self, message, book_id, epub, member):
+        """Serve a piece of a split document.  Working out the splits may
+        mean reading the whole book, so even finding it is done in a worker."""
+        key = (book_id, member)
+        
+        def respond(result):
+            if result is None:
+                message.set_status(Soup.Status.NOT_FOUND)
+                return
+            data, content_type = result
+            message.set_status(Soup.Status.OK)
+            message.set_response(content_type, Soup.MemoryUse.COPY, data)
+        
+        data = self.member_cache.get(key)
+        if data is not None:
+            return respond((data, self.guess_type(member.rpartition('~')[0])))
+        self.defer(message, self.read_piece, respond, book_id, epub, member)
+    
+    def read_piece(self, book_id, epub, member):
+        piece = epub.get_piece(member)
+        if piece is None:
+            return None
+        began = time.time()
+        data = epub.read_piece(*piece)
+        self.metrics.record_time('split', (time.time() - began) * 1000, len(data))
+        self.member_cache.put((book_id, member), data)
+        return data, self.guess_type(piece[0].filename)
+    
+    def scaled_image(self, message, book_id, epub, info, box):
+        # Not cached for long, since the box changes with the window size.
+        key = (book_id, info.filename, box)
+        if self.not_modified(message, '"%08x-%x-%ix%i"' % ((info.CRC, info.file_size) + box),
+                             time.mktime(info.date_time + (0, 0, -1))):
+            return
+        
+        def respond(result):
+            if result is None:
+                self.unscalable.add(key)
+                return self.from_epub(message, book_id, epub, info)
+            data, content_type = result
+            self.member_cache.put(key + (content_type,), data)
+            message.set_status(Soup.Status.OK)
+            message.set_response(content_type, Soup.MemoryUse.COPY, data)
+        
+        for content_type in imagescale.SCALABLE:
+            data = self.member_cache.get(key + (content_type,))
+            if data is not None:
+                return respond((data, content_type))
+        self.defer(message, self.scale_image, respond, epub, info, box)
+    
+    def scale_image(self, epub, info, box):
+        """Return the image scaled to fit box and its content type, from the
+        disk cache if it's there, or None if it fits already."""
+        cached = imagescale.load(info, box)
+        if cached is not None:
+            return cached
+        
+        began = time.time()
+        # The dimensions are usually near the start, even with EXIF data.
+        size = imagescale.image_size(epub.read_range(info, 0, min(info.file_size, 64 * 1024)))
+        target = size and imagescale.fit(size, box)
+        if not target:
+            return None
+        try:
+            data, content_type = imagescale.scale(epub.read_range(info, 0, info.file_size), target)
+        except GLib.GError:
+            return None
+        imagescale.save(info, box, data, content_type)
+        self.metrics.record_time('scale_image', (time.time() - began) * 1000, info.file_size)
+        return data, content_type
+    
+    def read_member(self, book_id, epub, info, prefetched=False):
+        data = self.read_range(epub, info, 0, info.file_size)
+        self.member_cache.put((book_id, info.filename), data, prefetched)
+        return data
+    
+    def read_range(self, epub, info, start, length):
+        began = time.time()
+        data = epub.read_range(info, start, length)
+        self.metrics.record_time('decompress', (time.time() - began) * 1000, len(data))
+        return data
+    
+    def read_block(self, f, size):
+        began = time.time()
+        data = f.read(size)
+        self.metrics.record_time('decompress_stream', (time.time() - began) * 1000, len(data))
+        return data
+    
+    def prefetch_neighbours(self, book_id, epub, info):
+        """If info is in the spine, load the components on either side of it,
+        and the resources they use, into the member cache."""
+        position = epub.spine_position(info)
+        if position is None:
+            return
+        for i in (position + 1, position - 1):
+            if 0 <= i < len(epub.spine):
+                component = epub.get_member(epub.spine[i])
+                if component is not None:
+                    self.prefetch(book_id, epub, component, True)
+    
+    def prefetch(self, book_id, epub, info, follow_links=False):
+        key = (book_id, info.filename)
+        if (key in self.prefetching or key in self.member_cache or
+                info.file_size > self.stream_threshold or info.filename in epub.obfuscated):
+            return
+        self.prefetching.add(key)
+        
+        def done(links):
+            self.prefetching.discard(key)
+            for link in links:
+                content_type = self.guess_type(link.filename)
+                if book_id in self.books and 'html' not in content_type:
+                    self.prefetch(book_id, epub, link, content_type == 'text/css')
+        
+        self.background(self.prefetch_member, done, lambda error: self.prefetching.discard(key),
+                        book_id, epub, info, follow_links)
+    
+    def prefetch_member(self, book_id, epub, info, follow_links):
+        data = self.read_member(book_id, epub, info, True)
+        if follow_links:
+            return epub.linked_members(info, data)
+        return []
+    
+    def stream_response(self, message, content_type, f, length):
+        """Send length bytes from the file-like f, reading the next block in
+        the worker pool only after Soup has written the previous one.  If the
+        client goes away, f is closed once any read in progress is done."""
+        message.response_headers.set_content_type(content_type, None)
+        message.response_headers.set_content_length(length)
+        message.response_body.set_accumulate(False)
+        state = {'remaining': length, 'reading': False, 'closed': False}
+        
+        def got_chunk(data):
+            if data:
+                message.response_body.append(data)
+                state['remaining'] -= len(data)
+            else:  # Truncated member
+                state['remaining'] = 0
+            if state['remaining'] <= 0:
+                message.response_body.complete()
+        
+        def chunk_failed(error):
+            state['remaining'] = 0
+            message.response_body.complete()
+        
+        def finish(callback, value):
+            state['reading'] = False
+            self.deferred[message] -= 1
+            if not self.deferred[message]:
+                del self.deferred[message]
+            if state['closed']:
+                f.close()
+                return
+            callback(value)
+            if message not in self.deferred:
+                self.unpause_message(message)
+        
+        def write_chunk(*args):
+            if state['remaining'] > 0 and not state['reading']:
+                state['reading'] = True
+                self.deferred[message] = self.deferred.get(message, 0) + 1
+                self.pause_message(message)
+                self.background(self.read_block, lambda data: finish(got_chunk, data),
+                                lambda error: finish(chunk_failed, error),
+                                f, min(self.chunk_size, state['remaining']))
+        
+        def finished(*args):
+            message.disconnect(wrote_id)
+            message.disconnect(finished_id)
+            state['closed'] = True
+            if not state['reading']:
+                f.close()
+        
+        wrote_id = message.connect('wrote-chunk', write_chunk)
+        finished_id = message.connect('finished', finished)
+        write_chunk()
+    
+    def not_modified(self, message, etag, mtime, max_age=0):
+        """Set the cache validators for a response.  If the client's copy is
+        still current, set the status to 304 and return True."""
+        headers = message.response_headers
+        headers.replace('ETag', etag)
+        headers.replace('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+        headers.replace('Cache-Control', 'max-age=%i' % max_age if max_age else 'no-cache')
+        
+        match = message.request_headers.get_one('If-None-Match')
+        if match is not None:
+            tags = [tag.strip() for tag in match.split(',')]
+            current = '*' in tags or etag in tags or 'W/' + etag in tags
+        else:
+            since = email.utils.parsedate_tz(message.request_headers.get_one('If-Modified-Since') or '')
+            current = since is not None and int(mtime) <= email.utils.mktime_tz(since)
+        if current:
+            message.set_status(Soup.Status.NOT_MODIFIED)
+        return current
     
     def guess_type(self, path):
         base, ext = posixpath.splitext(path)
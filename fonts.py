@@ -0,0 +1,75 @@
+import os
+import re
+import uuid
+import hashlib
+import bookcache
+
+# Font obfuscation algorithms named in META-INF/encryption.xml
+IDPF = 'http://www.idpf.org/2008/embedding'
+ADOBE = 'http://ns.adobe.com/pdf/enc#RC'
+# Bytes at the start of the font that each one scrambles
+OBFUSCATED_LENGTH = {IDPF: 1040, ADOBE: 1024}
+WHITESPACE_RE = re.compile(u'[\x20\x09\x0d\x0a]')
+
+def font_key(algorithm, identifiers):
+    """Return the key for algorithm, from the book's identifiers, unique
+    identifier first, or None if there isn't a suitable one."""
+    if algorithm == IDPF:
+        if identifiers:
+            return hashlib.sha1(WHITESPACE_RE.sub(u'', identifiers[0]).encode('utf-8')).digest()
+    elif algorithm == ADOBE:
+        for identifier in identifiers:
+            try:
+                return uuid.UUID(identifier.strip()).bytes
+            except ValueError:
+                pass
+    return None
+
+def deobfuscate(data, algorithm, key):
+    """Undo the obfuscation of the font data, by XORing its start with key."""
+    head = bytearray(data[:OBFUSCATED_LENGTH[algorithm]])
+    key = bytearray(key)
+    for i in range(len(head)):
+        head[i] ^= key[i % len(key)]
+    return bytes(head) + data[len(head):]
+
+def source_path(info, algorithm, key):
+    """Where to note the digest of the font decoded from the member info."""
+    name = '%08x-%x-%s' % (info.CRC, info.file_size,
+                           hashlib.sha1(algorithm.encode('utf-8') + key).hexdigest()[:16])
+    return os.path.join(bookcache.cache_dir('fonts', 'sources'), name)
+
+def font_path(digest):
+    return os.path.join(bookcache.cache_dir('fonts'), digest)
+
+def read(digest):
+    """Return the decoded font with digest from the cache, or None."""
+    try:
+        with open(font_path(digest), 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def load(info, algorithm, key):
+    """Return the digest and data of the font decoded from info, if it's in
+    the cache, or None."""
+    try:
+        with open(source_path(info, algorithm, key), 'rb') as f:
+            digest = f.read().strip()
+        with open(font_path(digest), 'rb') as f:
+            return digest, f.read()
+    except (IOError, OSError):
+        return None
+
+def save(info, algorithm, key, data):
+    """Store the font decoded from info under the digest of its contents,
+    so that books sharing a font share one copy, and return the digest."""
+    digest = hashlib.sha1(data).hexdigest()
+    try:
+        path = font_path(digest)
+        if not os.path.exists(path):
+            bookcache.write_atomic(path, data)
+        bookcache.write_atomic(source_path(info, algorithm, key), digest)
+    except OSError:
+        pass
+    return digest
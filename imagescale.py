@@ -0,0 +1,78 @@
+from gi.repository import GdkPixbuf
+import os
+import struct
+import bookcache
+
+# Raster types worth scaling down.  GIFs are left alone, since they may be animated.
+SCALABLE = ('image/jpeg', 'image/png')
+EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png'}
+
+def image_size(data):
+    """Return the (width, height) of the PNG or JPEG whose first bytes are
+    data, or None if they aren't found."""
+    if data[:8] == '\x89PNG\r\n\x1a\n' and data[12:16] == 'IHDR':
+        return struct.unpack('>II', data[16:24])
+    if data[:2] != '\xff\xd8':
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != '\xff':
+            return None
+        marker = ord(data[i + 1])
+        if marker == 0xff:  # Fill byte
+            i += 1
+        elif marker == 0x01 or 0xd0 <= marker <= 0xd8:  # No payload
+            i += 2
+        elif 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):  # Start of frame
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        else:
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+def fit(size, box):
+    """Return the size to scale an image of size to, to fit within box, or
+    None if it already fits."""
+    width, height = size
+    if width <= box[0] and height <= box[1]:
+        return None
+    scale = min(box[0] / float(width), box[1] / float(height))
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+def scale(data, size):
+    """Decode the image in data at size, and return the re-encoded image and
+    its content type.  Images with transparency stay PNGs; the rest become
+    JPEGs."""
+    loader = GdkPixbuf.PixbufLoader()
+    # Lets the JPEG loader decode at a reduced scale to begin with
+    loader.connect('size-prepared', lambda loader, width, height: loader.set_size(*size))
+    try:
+        loader.write(data)
+    finally:
+        loader.close()
+    pixbuf = loader.get_pixbuf()
+    if pixbuf.get_has_alpha():
+        ok, scaled = pixbuf.save_to_bufferv('png', [], [])
+        return scaled, 'image/png'
+    ok, scaled = pixbuf.save_to_bufferv('jpeg', ['quality'], ['85'])
+    return scaled, 'image/jpeg'
+
+def cache_path(info, box):
+    """Where to keep the image info scaled to fit box, less its extension."""
+    return os.path.join(bookcache.cache_dir('images'),
+                        '%08x-%x-%ix%i' % ((info.CRC, info.file_size) + box))
+
+def load(info, box):
+    """Return the image info scaled to fit box and its content type, if it's
+    in the cache, or None."""
+    path = cache_path(info, box)
+    for content_type in SCALABLE:
+        try:
+            with open(path + EXTENSIONS[content_type], 'rb') as f:
+                return f.read(), content_type
+        except IOError:
+            pass
+    return None
+
+def save(info, box, data, content_type):
+    bookcache.write_atomic(cache_path(info, box) + EXTENSIONS[content_type], data)
@@ -0,0 +1,221 @@
+"""Index the EPUBs in a set of directories.
+
+Books are parsed in a pool of processes, and their metadata, spine and
+cover are kept in an SQLite database.  Each book is keyed by its path,
+mtime and size, so a rescan only reparses the books that have changed.
+Run from cron with
+    
+    python library.py --add ~/Books
+    python library.py
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import multiprocessing
+from optparse import OptionParser
+import bookcache
+from epubserver import Epub
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS books (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    fingerprint TEXT,
+    title TEXT,
+    creator TEXT,
+    language TEXT,
+    metadata TEXT,
+    spine_length INTEGER,
+    spine_bytes INTEGER,
+    cover_path TEXT,
+    cover BLOB,
+    error TEXT,
+    indexed REAL NOT NULL
+);
+'''
+COLUMNS = ('path', 'mtime', 'size', 'fingerprint', 'title', 'creator', 'language', 'metadata',
+           'spine_length', 'spine_bytes', 'cover_path', 'cover', 'error', 'indexed')
+
+# Covers bigger than this are left in the book, and only their path is stored.
+MAX_COVER_SIZE = 512 * 1024
+
+def default_path():
+    return os.path.join(bookcache.cache_dir(), 'library.sqlite')
+
+def normpath(path):
+    """Return path as an absolute unicode path, the form kept in the index."""
+    if isinstance(path, bytes):
+        path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return os.path.abspath(path)
+
+def find_books(directory):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            # Names that can't be decoded come back as bytes; skip them.
+            if isinstance(filename, unicode) and filename.lower().endswith('.epub'):
+                yield os.path.join(dirpath, filename)
+
+def index_book(job):
+    """Parse the book at path, returning a row for the books table.  Run in
+    the worker processes, so books that can't be parsed are recorded with
+    their error rather than raising."""
+    path, mtime, size = job
+    row = dict.fromkeys(COLUMNS)
+    row.update(path=path, mtime=mtime, size=size)
+    try:
+        epub = Epub(path)
+        try:
+            row.update(fingerprint=epub.fingerprint,
+                       title=epub.metadata.get('title'),
+                       creator=epub.metadata.get('creator'),
+                       language=epub.metadata.get('language'),
+                       metadata=json.dumps(epub.metadata),
+                       spine_length=len(epub.spine))
+            members = [epub.get_member(href) for href in epub.spine]
+            row['spine_bytes'] = sum(info.file_size for info in members if info is not None)
+            cover = epub.cover and epub.get_member(epub.cover)
+            if cover is not None:
+                row['cover_path'] = cover.filename
+                if cover.file_size <= MAX_COVER_SIZE:
+                    row['cover'] = epub.read(cover)
+        finally:
+            epub.close()
+    except Exception as error:
+        row['error'] = '%s: %s' % (type(error).__name__, error)
+    row['indexed'] = time.time()
+    return row
+
+
+class Library(object):
+    """The index of books in the user's directories."""
+    
+    # Rows written between commits while scanning
+    batch_size = 100
+    
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+    
+    def close(self):
+        self.db.close()
+    
+    def directories(self):
+        return [row[0] for row in self.db.execute('SELECT path FROM directories ORDER BY path')]
+    
+    def add_directory(self, path):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO directories VALUES (?)',
+                            (normpath(path),))
+    
+    def remove_directory(self, path):
+        """Stop indexing path.  Its books are dropped on the next scan."""
+        with self.db:
+            self.db.execute('DELETE FROM directories WHERE path = ?', (normpath(path),))
+    
+    def books(self):
+        return self.db.execute('SELECT * FROM books WHERE error IS NULL ORDER BY title, path')
+    
+    def get(self, path):
+        return self.db.execute('SELECT * FROM books WHERE path = ?',
+                               (normpath(path),)).fetchone()
+    
+    def scan(self, processes=None, progress=None):
+        """Bring the index up to date with the directories, parsing new and
+        changed books in processes workers (default, one per core).  Calls
+        progress(row) after each book is parsed.  Returns a dict counting
+        the books indexed, failed, removed and unchanged."""
+        known = dict((row['path'], (row['mtime'], row['size']))
+                     for row in self.db.execute('SELECT path, mtime, size FROM books'))
+        seen = set()
+        jobs = []
+        for directory in self.directories():
+            for path in find_books(directory):
+                if path in seen:
+                    continue
+                seen.add(path)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if known.get(path) != (stat.st_mtime, stat.st_size):
+                    jobs.append((path, stat.st_mtime, stat.st_size))
+        
+        counts = {'indexed': 0, 'failed': 0, 'removed': 0, 'unchanged': len(seen) - len(jobs)}
+        removed = [(path,) for path in known if path not in seen]
+        with self.db:
+            self.db.executemany('DELETE FROM books WHERE path = ?', removed)
+        counts['removed'] = len(removed)
+        if not jobs:
+            return counts
+        
+        sql = 'INSERT OR REPLACE INTO books (%s) VALUES (%s)' % (', '.join(COLUMNS),
+                                                                 ', '.join('?' * len(COLUMNS)))
+        pool = multiprocessing.Pool(processes)
+        try:
+            workers = processes or multiprocessing.cpu_count()
+            chunksize = max(1, min(16, len(jobs) // (4 * workers)))
+            for i, row in enumerate(pool.imap_unordered(index_book, jobs, chunksize)):
+                if row['cover'] is not None:
+                    row['cover'] = sqlite3.Binary(row['cover'])
+                self.db.execute(sql, [row[column] for column in COLUMNS])
+                counts['failed' if row['error'] else 'indexed'] += 1
+                if i % self.batch_size == self.batch_size - 1:
+                    self.db.commit()
+                if progress is not None:
+                    progress(row)
+            self.db.commit()
+        finally:
+            pool.terminate()
+            pool.join()
+        return counts
+
+def main(args):
+    parser = OptionParser(usage="python library.py [options]",
+                          description=__doc__.split('\n')[0])
+    parser.add_option('--add', action='append', default=[], metavar='DIR',
+                      help='add a directory to the library')
+    parser.add_option('--remove', action='append', default=[], metavar='DIR',
+                      help='remove a directory from the library')
+    parser.add_option('--database', metavar='FILE', help='index to use (default: %s)'
+                      % default_path())
+    parser.add_option('--jobs', type='int', help='worker processes (default: one per core)')
+    parser.add_option('--list', action='store_true', help='list the indexed books')
+    parser.add_option('-v', '--verbose', action='store_true', help='print each book indexed')
+    options, args = parser.parse_args(args)
+    
+    library = Library(options.database)
+    for directory in options.add:
+        library.add_directory(directory)
+    for directory in options.remove:
+        library.remove_directory(directory)
+    
+    def progress(row):
+        if row['error']:
+            sys.stderr.write('%s: %s\n' % (row['path'], row['error']))
+        elif options.verbose:
+            print row['path']
+    
+    start = time.time()
+    counts = library.scan(options.jobs, progress)
+    if options.verbose or counts['indexed'] or counts['failed'] or counts['removed']:
+        counts['time'] = time.time() - start
+        print ('%(indexed)i indexed, %(failed)i failed, %(removed)i removed, '
+               '%(unchanged)i unchanged in %(time).1f s' % counts)
+    if options.list:
+        for row in library.books():
+            print '%s\t%s\t%s' % (row['title'], row['creator'], row['path'])
+    library.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
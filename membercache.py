@@ -0,0 +1,56 @@
+import collections
+import threading
+
+class MemberCache(object):
+    """A least-recently-used cache of decompressed members, bounded by their
+    total size.  Safe to use from the worker threads."""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+    
+    def get(self, key):
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+            else:
+                self.entries[key] = data
+                self.hits += 1
+            return data
+    
+    def __contains__(self, key):
+        return key in self.entries
+    
+    def put(self, key, data, prefetched=False):
+        with self.lock:
+            if key in self.entries or len(data) > self.max_bytes:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            if prefetched:
+                self.prefetched += 1
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+    
+    def discard(self, prefix):
+        """Drop all entries whose keys start with prefix."""
+        with self.lock:
+            for key in [key for key in self.entries if key[:len(prefix)] == prefix]:
+                self.size -= len(self.entries.pop(key))
+    
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'prefetched': self.prefetched,
+                'entries': len(self.entries),
+                'bytes': self.size}
@@ -0,0 +1,65 @@
+import bisect
+import threading
+
+class Histogram(object):
+    """Counts of values, in milliseconds, falling under each bucket boundary."""
+    
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+    
+    def as_dict(self):
+        buckets = dict(('le_%i' % bound, count) for bound, count in zip(self.BUCKETS, self.counts))
+        buckets['inf'] = self.counts[-1]
+        return {'count': self.count,
+                'total_ms': self.total,
+                'mean_ms': self.total / self.count if self.count else 0,
+                'max_ms': self.max,
+                'buckets': buckets}
+
+
+class Metrics(object):
+    """Request counts, bytes and latencies per handler, plus timings of named
+    operations.  Safe to update from the worker threads."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handlers = {}
+        self.timings = {}
+    
+    def record_request(self, handler, status, nbytes, ms):
+        with self.lock:
+            stats = self.handlers.get(handler)
+            if stats is None:
+                stats = self.handlers[handler] = {'requests': 0, 'bytes': 0, 'status': {},
+                                                  'latency': Histogram()}
+            stats['requests'] += 1
+            stats['bytes'] += nbytes
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            stats['latency'].add(ms)
+    
+    def record_time(self, name, ms, nbytes=None):
+        with self.lock:
+            stats = self.timings.get(name)
+            if stats is None:
+                stats = self.timings[name] = {'bytes': 0, 'time': Histogram()}
+            stats['time'].add(ms)
+            if nbytes is not None:
+                stats['bytes'] += nbytes
+    
+    def as_dict(self):
+        with self.lock:
+            return {'handlers': dict((name, dict(stats, latency=stats['latency'].as_dict()))
+                                     for name, stats in self.handlers.items()),
+                    'timings': dict((name, dict(stats, time=stats['time'].as_dict()))
+                                    for name, stats in self.timings.items())}
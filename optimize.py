@@ -0,0 +1,237 @@
+"""Repack EPUBs into a layout that is quick to serve.
+
+Members that are already compressed, like JPEGs and audio, are stored
+rather than deflated, so they can be served straight out of the archive.
+Each spine document is followed by the resources it uses, in spine order,
+and the parsed OPF and table of contents are embedded in the book, so that
+opening it needn't parse them.  Each repacked book is checked against the
+original before it is kept.  Books are repacked in a pool of processes:
+    
+    python optimize.py --output ~/Books-optimized ~/Books
+    python optimize.py --in-place book.epub
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import zipfile
+import mimetypes
+import multiprocessing
+from optparse import OptionParser
+from epubserver import Epub, INDEX_MEMBER, INDEX_VERSION, members_digest, member_positions
+from library import find_books, normpath
+
+# Types that deflate doesn't shrink enough to be worth inflating on every read
+PRECOMPRESSED_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'application/zip',
+                       'font/woff', 'font/woff2', 'application/font-woff')
+PRECOMPRESSED_PREFIXES = ('audio/', 'video/')
+PRECOMPRESSED_EXTENSIONS = ('.woff', '.woff2', '.webp')
+# Other members are stored too, if deflate saves less than this fraction
+MIN_SAVING = 0.1
+EPUB_MIMETYPE = 'application/epub+zip'
+
+
+class ParsedEpub(Epub):
+    """An Epub that parses the OPF, rather than trusting any cache or index."""
+    use_cache = False
+    use_index = False
+
+
+class IndexedEpub(Epub):
+    """An Epub that may use its embedded index, but not the cache."""
+    use_cache = False
+
+def should_store(name, data):
+    """Whether to store data uncompressed: media that's compressed already,
+    or anything else that deflate barely shrinks."""
+    content_type = mimetypes.guess_type(name)[0] or ''
+    if (name.lower().endswith(PRECOMPRESSED_EXTENSIONS) or content_type in PRECOMPRESSED_TYPES or
+            content_type.startswith(PRECOMPRESSED_PREFIXES)):
+        return True
+    return len(zlib.compress(data, 1)) > len(data) * (1 - MIN_SAVING)
+
+def member_order(epub):
+    """Return the members of epub in the order to write them: the mimetype,
+    META-INF, then each spine document followed by the resources it uses
+    that haven't appeared yet, then everything else."""
+    order = []
+    placed = set()
+    
+    def place(info):
+        if info.filename not in placed and info.filename != INDEX_MEMBER:
+            placed.add(info.filename)
+            order.append(info)
+    
+    infos = [info for info in epub.infolist() if not info.filename.endswith('/')]
+    for info in infos:
+        if info.filename == 'mimetype':
+            place(info)
+    for info in infos:
+        if info.filename.startswith('META-INF/'):
+            place(info)
+    for href in epub.spine:
+        info = epub.get_member(href)
+        if info is None or info.filename in placed:
+            continue
+        place(info)
+        for link in epub.linked_members(info, epub.read(info)):
+            place(link)
+    for info in infos:
+        place(info)
+    return order
+
+def parsed_state(epub):
+    """Return what epub parsed to, with members by name rather than by
+    position, for comparing the repacked book with the original."""
+    state = json.loads(json.dumps(epub.snapshot()))
+    state.update(obfuscated=epub.obfuscated,
+                 members=dict((key, info.filename) for key, info in epub.members.items()),
+                 members_folded=dict((key, info.filename)
+                                     for key, info in epub.members_folded.items()))
+    return state
+
+def make_index(epub, out):
+    """Return the index of epub to embed in its repacked copy, out."""
+    return dict(epub.snapshot(member_positions(out)), version=INDEX_VERSION,
+                digest=members_digest(out))
+
+def repack(source, output):
+    """Write an optimized copy of the book at source to output."""
+    epub = ParsedEpub(source)
+    try:
+        order = member_order(epub)
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as out:
+            # The OCF requires this first, stored, with no extra field.
+            mimetype = zipfile.ZipInfo('mimetype', (1980, 1, 1, 0, 0, 0))
+            data = EPUB_MIMETYPE
+            if order and order[0].filename == 'mimetype':
+                mimetype.date_time = order.pop(0).date_time
+                data = epub.read('mimetype').strip() or EPUB_MIMETYPE
+            mimetype.compress_type = zipfile.ZIP_STORED
+            out.writestr(mimetype, data)
+            
+            for info in order:
+                data = epub.read(info)
+                copy = zipfile.ZipInfo(info.filename, info.date_time)
+                copy.external_attr = info.external_attr
+                copy.compress_type = (zipfile.ZIP_STORED if should_store(info.filename, data)
+                                      else zipfile.ZIP_DEFLATED)
+                out.writestr(copy, data)
+            
+            # Last, since it covers the CRCs of everything else
+            index = zipfile.ZipInfo(INDEX_MEMBER, time.localtime()[:6])
+            index.compress_type = zipfile.ZIP_DEFLATED
+            out.writestr(index, json.dumps(make_index(epub, out)).encode('utf-8'))
+    finally:
+        epub.close()
+
+def verify(source, output):
+    """Raise ValueError unless the book at output has the same members and
+    parses the same as the one at source, and its embedded index is used."""
+    original = ParsedEpub(source)
+    try:
+        indexed = IndexedEpub(output)
+        try:
+            infos = indexed.infolist()
+            if not infos or infos[0].filename != 'mimetype' or infos[0].compress_type:
+                raise ValueError("mimetype isn't the first member, stored")
+            if 'index' not in indexed.parse_times:
+                raise ValueError("embedded index not used")
+            bad = indexed.testzip()
+            if bad is not None:
+                raise ValueError("bad CRC for %s" % bad)
+            for info in original.infolist():
+                if info.filename.endswith('/') or info.filename in ('mimetype', INDEX_MEMBER):
+                    continue
+                copy = indexed.NameToInfo.get(info.filename)
+                if copy is None or (copy.CRC, copy.file_size) != (info.CRC, info.file_size):
+                    raise ValueError("%s differs" % info.filename)
+            expected = parsed_state(original)
+            if parsed_state(indexed) != expected:
+                raise ValueError("embedded index doesn't match the book")
+            reparsed = ParsedEpub(output)
+            try:
+                if parsed_state(reparsed) != expected:
+                    raise ValueError("repacked book parses differently")
+            finally:
+                reparsed.close()
+        finally:
+            indexed.close()
+    finally:
+        original.close()
+
+def optimize_book(job):
+    """Repack and verify the book at source, and move it to output.  Run in
+    the worker processes, so failures are returned rather than raised.
+    Returns (source, output, old size, new size, error)."""
+    source, output = job
+    temp = output + '.tmp'
+    try:
+        directory = os.path.dirname(output)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        repack(source, temp)
+        verify(source, temp)
+        sizes = os.path.getsize(source), os.path.getsize(temp)
+        os.rename(temp, output)
+        return (source, output) + sizes + (None,)
+    except Exception as error:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return source, output, None, None, '%s: %s' % (type(error).__name__, error)
+
+def find_jobs(paths, output=None):
+    """Return (source, output) pairs for the books at paths, which may be
+    directories.  Without an output directory, books are replaced."""
+    jobs = []
+    for path in paths:
+        path = normpath(path)
+        if os.path.isdir(path):
+            sources = [(source, os.path.relpath(source, path)) for source in find_books(path)]
+        else:
+            sources = [(path, os.path.basename(path))]
+        for source, name in sources:
+            jobs.append((source, os.path.join(output, name) if output else source))
+    return jobs
+
+def main(args):
+    parser = OptionParser(usage="python optimize.py [options] BOOK|DIR ...",
+                          description=__doc__.split('\n')[0])
+    parser.add_option('-o', '--output', metavar='DIR', help='write the repacked books here')
+    parser.add_option('--in-place', action='store_true', help='replace the books')
+    parser.add_option('--jobs', type='int', help='worker processes (default: one per core)')
+    parser.add_option('-v', '--verbose', action='store_true', help='print each book repacked')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error("no books given")
+    if bool(options.output) == bool(options.in_place):
+        parser.error("give one of --output or --in-place")
+    
+    start = time.time()
+    jobs = find_jobs(args, options.output and os.path.abspath(options.output))
+    counts = {'repacked': 0, 'failed': 0, 'before': 0, 'after': 0}
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        for source, output, before, after, error in pool.imap_unordered(optimize_book, jobs):
+            if error:
+                sys.stderr.write('%s: %s\n' % (source, error))
+                counts['failed'] += 1
+                continue
+            counts['repacked'] += 1
+            counts['before'] += before
+            counts['after'] += after
+            if options.verbose:
+                print '%s: %i -> %i bytes' % (output, before, after)
+    finally:
+        pool.terminate()
+        pool.join()
+    counts['time'] = time.time() - start
+    print ('%(repacked)i repacked, %(failed)i failed, %(before)i -> %(after)i bytes '
+           'in %(time).1f s' % counts)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,61 @@
+from gi.repository import GLib, Gtk, WebKit
+import os
+import json
+import hashlib
+import bookcache
+
+def cache_key(fingerprint, width, height, settings):
+    """Identify a layout of a book: its fingerprint, the size of the view,
+    and the reader settings."""
+    return hashlib.sha1(json.dumps([fingerprint, width, height, settings],
+                                   sort_keys=True)).hexdigest()
+
+def cache_path(key):
+    return os.path.join(bookcache.cache_dir('pagination'), key + '.json')
+
+def load(key):
+    """Return the pagination stored under key, or None."""
+    return bookcache.read_json(cache_path(key))
+
+def save(key, pages):
+    """Store the page counts of each component under key, along with the
+    page number each component starts on.  Returns the stored data."""
+    offsets = []
+    total = 0
+    for count in pages:
+        offsets.append(total)
+        total += count
+    data = {'pages': pages, 'offsets': offsets, 'total': total}
+    bookcache.write_json(cache_path(key), data)
+    return data
+
+
+class Paginator(object):
+    """Lay out each component of a book in turn in a hidden WebView of the
+    given size, and pass the list of their page counts to done."""
+    
+    def __init__(self, uri, width, height, styles_script, done):
+        self.styles_script = styles_script
+        self.done = done
+        self.window = Gtk.OffscreenWindow()
+        self.view = WebKit.WebView()
+        self.view.set_size_request(width, height)
+        self.view.connect('console-message', self.on_console_message)
+        self.window.add(self.view)
+        self.window.show_all()
+        self.view.load_uri(uri)
+    
+    def on_console_message(self, web_view, message, line, source_id):
+        if message == 'Ready':
+            self.view.execute_script(self.styles_script + 'paginateBook();')
+        elif message.startswith('Pagination '):
+            # Not from within the view's own signal handler
+            GLib.idle_add(self.cancel)
+            self.done(json.loads(message[len('Pagination '):]))
+        return True
+    
+    def cancel(self):
+        if self.window is not None:
+            self.window.destroy()
+            self.window = self.view = None
+        return False
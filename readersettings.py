@@ -1,5 +1,6 @@
 from gi.repository import Gtk, Gdk, GObject
 import os
+import json
 
 def make_color(spec):
     return Gdk.Color.parse(spec)[1]
@@ -20,6 +21,8 @@ class ReaderSettings(object):
                         'margin_right': 10,
                         'margin_bottom': 10,
                        }
+    # Changes made within this many milliseconds are sent to the page together.
+    batch_delay = 100
     
     def __init__(self, parent, **kw):
         self.parent = parent
@@ -44,6 +47,9 @@ class ReaderSettings(object):
         self._margin_right = builder.get_object('margin-right-button')
         self._margin_bottom = builder.get_object('margin-bottom-button')
         self._updating = False
+        # The settings the page has been sent
+        self._sent = {}
+        self._send_timeout = None
         
         settings = self.DEFAULT_SETTINGS.copy()
         settings.update(kw)
@@ -162,16 +168,46 @@ class ReaderSettings(object):
                 setattr(self, k, value[k])
         self._updating = False
     
+    def styles_script(self):
+        """Return the script applying all of the settings to a fresh page."""
+        return 'applySettings(%s);' % json.dumps(self.dict)
+    
     def update_styles(self, *args):
-        if not self._updating:
-            self.parent.view.execute_script(("updateStyles('{text_color}', '{background_color}', " +
-                "'{font}', {line_height}, {default_font:b}, {font_scale}, {margin_top}, {margin_left}, " +
-                "{margin_right}, {margin_bottom});").format(**self.dict))
+        if self._updating:
+            return False
+        if self._send_timeout is not None:
+            GObject.source_remove(self._send_timeout)
+        self._send_timeout = GObject.timeout_add(self.batch_delay, self.send_styles)
+        return False
+    
+    def send_styles(self):
+        """Send the page the settings that have changed since it last heard."""
+        self._send_timeout = None
+        settings = self.dict
+        changes = dict((k, v) for k, v in settings.items()
+                       if k not in self._sent or self._sent[k] != v)
+        if changes:
+            self.parent.execute_script('applySettings(%s);' % json.dumps(changes))
+            self._sent = settings
+            self.parent.application.store.set_settings(settings)
+            self.parent.schedule_pagination()
+        return False
+    
+    def page_loaded(self):
+        """Send all of the settings to a newly loaded page."""
+        if self._send_timeout is not None:
+            GObject.source_remove(self._send_timeout)
+        self._sent = {}
+        self.send_styles()
     
     def on_font_scale(self, widget):
         if self._font_scale_timeout is not None:
             GObject.source_remove(self._font_scale_timeout)
-        self._font_scale_timeout = GObject.timeout_add(500, self.update_styles)
+        self._font_scale_timeout = GObject.timeout_add(500, self.on_font_scale_timeout)
+    
+    def on_font_scale_timeout(self):
+        self._font_scale_timeout = None
+        return self.update_styles()
     
     def on_default_font_toggled(self, widget):
         self._font.set_sensitive(not self.default_font)
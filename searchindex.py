@@ -0,0 +1,197 @@
+import re
+import math
+import zlib
+import base64
+import heapq
+import bisect
+import codecs
+import itertools
+from array import array
+from HTMLParser import HTMLParser
+import bookcache
+
+WORD_RE = re.compile(r'\w+', re.U)
+TAG_RE = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>|</?(\w*)[^>]*>', re.S | re.I)
+BODY_RE = re.compile(r'<body\b', re.I)
+ENCODING_RE = re.compile(r'''^<\?xml[^>]*\bencoding\s*=\s*["']([\w.:-]+)''')
+# Tags that don't separate words
+INLINE = frozenset(('a', 'abbr', 'b', 'bdi', 'bdo', 'cite', 'code', 'dfn', 'em', 'font', 'i',
+                    'kbd', 'mark', 'q', 's', 'samp', 'small', 'span', 'strong', 'sub', 'sup',
+                    'time', 'tt', 'u', 'var'))
+
+def read_text(epub, href):
+    """Return the text of the component href of epub, or nothing if it's missing."""
+    data = epub.read_component(href)
+    if data is None:
+        return u''
+    return extract_text(data)
+
+def extract_text(data):
+    """Return the text of the body of an XHTML document, with whitespace
+    collapsed, as unicode."""
+    encoding = 'utf-8'
+    match = ENCODING_RE.match(data)
+    if match:
+        try:
+            encoding = codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    text = data.decode(encoding, 'replace')
+    body = BODY_RE.search(text)
+    if body:
+        text = text[body.start():]
+    
+    unescape = HTMLParser().unescape
+    pieces = []
+    end = 0
+    for match in TAG_RE.finditer(text):
+        pieces.append(unescape(text[end:match.start()]))
+        if (match.group(2) or '').lower() not in INLINE:
+            pieces.append(u' ')
+        end = match.end()
+    pieces.append(unescape(text[end:]))
+    # Splitting collapses whitespace much faster than a regex.
+    return u' '.join(u''.join(pieces).split())
+
+
+class SearchIndex(object):
+    """An inverted index of the words in the components of a book.  Each
+    word's postings are an array of offsets into the text of the whole book,
+    in reading order.  Only the length of each component's text is kept; the
+    text for snippets is extracted again from the few components hit."""
+    
+    # Characters of context on either side of a hit
+    snippet_chars = 60
+    # Query words within this many characters of each other count as a match together
+    window = 200
+    
+    def __init__(self, epub, components, starts, postings):
+        self.epub = epub
+        self.components = components
+        # Offset of each component's text, and then of the end of the book
+        self.starts = starts
+        # word -> array of sorted offsets
+        self.postings = postings
+    
+    @classmethod
+    def build(cls, epub):
+        """Index the components of epub, reading each document with the
+        calling thread's handle."""
+        components = epub.components()
+        starts = array('I', [0])
+        postings = {}
+        for href in components:
+            text = read_text(epub, href)
+            start = starts[-1]
+            for match in WORD_RE.finditer(text):
+                word = match.group().lower()
+                offsets = postings.get(word)
+                if offsets is None:
+                    offsets = postings[word] = array('I')
+                offsets.append(start + match.start())
+            starts.append(start + len(text))
+        return cls(epub, components, starts, postings)
+    
+    @classmethod
+    def for_book(cls, epub):
+        """Load the index for epub from the cache, or build and save it."""
+        data = epub.use_cache and bookcache.load(epub, '.search.json')
+        if data:
+            offsets = array('I')
+            offsets.fromstring(zlib.decompress(base64.b64decode(data['offsets'])))
+            postings = {}
+            end = 0
+            for word, count in itertools.izip(data['words'], data['counts']):
+                postings[word] = offsets[end:end + count]
+                end += count
+            return cls(epub, data['components'], array('I', data['starts']), postings)
+        index = cls.build(epub)
+        if epub.use_cache:
+            bookcache.save(epub, index.snapshot(), '.search.json')
+        return index
+    
+    def snapshot(self):
+        """Return the index as a JSON-able dict, with the postings of all the
+        words run together in one compressed blob."""
+        words = list(self.postings)
+        offsets = array('I')
+        for word in words:
+            offsets.extend(self.postings[word])
+        return {'components': self.components,
+                'starts': self.starts.tolist(),
+                'words': words,
+                'counts': [len(self.postings[word]) for word in words],
+                'offsets': base64.b64encode(zlib.compress(offsets.tostring()))}
+    
+    def component_at(self, offset):
+        return bisect.bisect_right(self.starts, offset) - 1
+    
+    def components_with(self, offsets):
+        """Return the set of components that offsets fall in."""
+        found = set()
+        k = 0
+        while k < len(offsets):
+            i = self.component_at(offsets[k])
+            found.add(i)
+            k = bisect.bisect_left(offsets, self.starts[i + 1], k)
+        return found
+    
+    def search(self, query, limit=20):
+        """Return up to limit hits for the words of query, best first.  Every
+        word must appear in a hit's component; hits with more of the words
+        close by rank higher, and ties go in reading order.  Reads the
+        components hit, with the calling thread's handle."""
+        words = []
+        for word in WORD_RE.findall(query.lower()):
+            if word not in words:
+                words.append(word)
+        entries = [self.postings.get(word) for word in words]
+        if not words or None in entries:
+            return []
+        # Anchor the hits on the rarest word.
+        anchor = min(range(len(words)), key=lambda j: len(entries[j]))
+        
+        if len(words) == 1:
+            best = entries[0][:limit]
+        else:
+            found = [self.components_with(offsets) for offsets in entries]
+            components = found[0].intersection(*found[1:])
+            weights = [math.log(1.0 + (len(self.starts) - 1) / float(len(f))) for f in found]
+            scored = []
+            for i in components:
+                first, end = self.starts[i], self.starts[i + 1]
+                # Where each word's offsets in the component begin and end
+                bounds = [[bisect.bisect_left(offsets, first), bisect.bisect_left(offsets, end)]
+                          for offsets in entries]
+                lo, hi = bounds[anchor]
+                for offset in itertools.islice(entries[anchor], lo, hi):
+                    low = max(offset - self.window, first)
+                    high = offset + self.window
+                    score = 0.0
+                    for weight, offsets, bound in zip(weights, entries, bounds):
+                        # Offsets only go up, so each search can start where the last ended.
+                        k = bound[0] = bisect.bisect_left(offsets, low, bound[0], bound[1])
+                        if k < bound[1] and offsets[k] <= high:
+                            score += weight
+                    scored.append((score, -offset))
+            best = [-offset for score, offset in heapq.nlargest(limit, scored)]
+        
+        texts = {}
+        hits = []
+        for offset in best:
+            i = self.component_at(offset)
+            if i not in texts:
+                texts[i] = read_text(self.epub, self.components[i])
+            hits.append(self.hit(i, texts[i], offset - self.starts[i], len(words[anchor])))
+        return hits
+    
+    def hit(self, i, text, offset, length):
+        start = max(0, offset - self.snippet_chars)
+        end = min(len(text), offset + length + self.snippet_chars)
+        return {'component': self.components[i],
+                'index': i,
+                'offset': offset,
+                'percent': offset / float(self.starts[i + 1] - self.starts[i]),
+                'snippet': text[start:end],
+                'match': [offset - start, length],
+                'truncated': [start > 0, end < len(text)]}
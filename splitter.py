@@ -0,0 +1,93 @@
+import re
+
+# Elements a document may be split before
+BLOCK = frozenset(('address', 'article', 'aside', 'blockquote', 'dd', 'div', 'dl', 'dt',
+                   'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li',
+                   'ol', 'p', 'pre', 'section', 'table', 'ul'))
+# Elements with no end tag, if the document is careless enough to leave them open
+VOID = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                  'param', 'source', 'track', 'wbr'))
+TAG_RE = re.compile(r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<(script|style)\b.*?</\1\s*>|'
+                    r'<(/?)([\w:.-]+)((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(/?)>', re.S | re.I)
+BODY_RE = re.compile(r'<body\b[^>]*>', re.I)
+BODY_END_RE = re.compile(r'</body\s*>', re.I)
+ID_RE = re.compile(r'''\s(?:xml:)?(?:id|name)\s*=\s*(["'])(.*?)\1''', re.S)
+ID_ATTR_RE = re.compile(r'''\s+(?:xml:)?id\s*=\s*(["']).*?\1''', re.S)
+LOCAL_LINK_RE = re.compile(r'''(\bhref\s*=\s*["'])#([^"']+)''', re.I)
+
+def split(data, size):
+    """Work out where to split the XHTML document data into pieces of about
+    size bytes, each beginning with a block element.  Returns None if there
+    is nowhere to split it.
+    
+    Offsets are into data.  Each piece is [start, end, open], where open
+    lists the start tags of the elements still open at start, which are
+    opened again at the beginning of the piece, and closed at the end of
+    the one before.  Tags and the tail of the document are kept as
+    latin-1, to survive JSON whatever the document's encoding."""
+    if data.startswith(('\xff\xfe', '\xfe\xff')):  # UTF-16
+        return None
+    body = BODY_RE.search(data)
+    if not body:
+        return None
+    body_end = BODY_END_RE.search(data, body.end())
+    end = body_end.start() if body_end else len(data)
+    
+    pieces = []
+    ids = {}
+    stack = []
+    start = body.end()
+    opened = []
+    for match in TAG_RE.finditer(data, body.end(), end):
+        closing, name, attrs, empty = match.group(2, 3, 4, 5)
+        if name is None:
+            continue
+        name = name.lower()
+        if closing:
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    del stack[i:]
+                    break
+            continue
+        if name in BLOCK and match.start() - start >= size:
+            pieces.append([start, match.start(), opened])
+            start = match.start()
+            opened = [tag for tag_name, tag in stack]
+        for id_match in ID_RE.finditer(attrs):
+            ids.setdefault(id_match.group(2).decode('utf-8', 'replace'), len(pieces))
+        if not empty and name not in VOID:
+            stack.append((name, match.group().decode('latin-1')))
+    if not pieces:
+        return None
+    pieces.append([start, end, opened])
+    return {'head': body.end(), 'pieces': pieces, 'ids': ids,
+            'tail': data[end:].decode('latin-1')}
+
+def assemble(head, content, split, index, name):
+    """Return the index'th piece of a document as a document of its own.
+    head is the document up to the end of its body tag, content the bytes
+    of the piece, and name the URL-encoded file name of the document, for
+    links to the other pieces."""
+    start, end, opened = split['pieces'][index]
+    if index + 1 < len(split['pieces']):
+        closing = split['pieces'][index + 1][2]
+    else:
+        closing = []
+    ids = split['ids']
+    
+    def link(match):
+        target = ids.get(match.group(2).decode('utf-8', 'replace'), index)
+        if target == index:
+            return match.group()
+        return '%s%s#%s' % (match.group(1), piece_href(name, target), match.group(2))
+    
+    parts = [head]
+    parts.extend(ID_ATTR_RE.sub('', tag).encode('latin-1') for tag in opened)
+    parts.append(LOCAL_LINK_RE.sub(link, content))
+    parts.extend('</%s>' % TAG_RE.match(tag.encode('latin-1')).group(3)
+                 for tag in reversed(closing))
+    parts.append(split['tail'].encode('latin-1'))
+    return ''.join(parts)
+
+def piece_href(href, index):
+    return '%s~%i' % (href, index)
@@ -0,0 +1,101 @@
+from gi.repository import GLib
+import os
+import sys
+import json
+import time
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS positions (
+    path TEXT PRIMARY KEY,
+    locus TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+def default_path():
+    directory = os.path.join(GLib.get_user_data_dir(), 'berg')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, 'state.sqlite')
+
+def book_key(path):
+    if isinstance(path, bytes):
+        path = path.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+    return os.path.abspath(path)
+
+
+class Store(object):
+    """The reading position in each book and the reader settings.  Changes
+    are kept in memory and written together every flush_interval seconds,
+    or when flush is called."""
+    
+    flush_interval = 5
+    
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path or default_path())
+        self.db.executescript(SCHEMA)
+        self.pending_positions = {}
+        self.pending_settings = None
+        self._flush_timeout = None
+        self.flushes = 0
+    
+    def position(self, path):
+        """Return the Monocle locus saved for the book at path, or None."""
+        path = book_key(path)
+        if path in self.pending_positions:
+            return self.pending_positions[path]
+        row = self.db.execute('SELECT locus FROM positions WHERE path = ?', (path,)).fetchone()
+        return row and json.loads(row[0])
+    
+    def set_position(self, path, locus):
+        self.pending_positions[book_key(path)] = locus
+        self.schedule_flush()
+    
+    def settings(self):
+        if self.pending_settings is not None:
+            return dict(self.pending_settings)
+        return dict((name, json.loads(value))
+                    for name, value in self.db.execute('SELECT name, value FROM settings'))
+    
+    def set_settings(self, settings):
+        self.pending_settings = dict(settings)
+        self.schedule_flush()
+    
+    def schedule_flush(self):
+        if self._flush_timeout is None:
+            self._flush_timeout = GLib.timeout_add_seconds(self.flush_interval,
+                                                           self.on_flush_timeout)
+    
+    def on_flush_timeout(self):
+        self._flush_timeout = None
+        self.flush()
+        return False
+    
+    def flush(self):
+        """Write out any pending changes, in a single transaction."""
+        if self._flush_timeout is not None:
+            GLib.source_remove(self._flush_timeout)
+            self._flush_timeout = None
+        if not self.pending_positions and self.pending_settings is None:
+            return
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO positions VALUES (?, ?, ?)',
+                                [(path, json.dumps(locus), now)
+                                 for path, locus in self.pending_positions.items()])
+            if self.pending_settings is not None:
+                self.db.executemany('INSERT OR REPLACE INTO settings VALUES (?, ?)',
+                                    [(name, json.dumps(value))
+                                     for name, value in self.pending_settings.items()])
+        self.pending_positions.clear()
+        self.pending_settings = None
+        self.flushes += 1
+    
+    def close(self):
+        self.flush()
+        self.db.close()
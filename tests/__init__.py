@@ -0,0 +1,8 @@
+import os
+import shutil
+import atexit
+import tempfile
+
+# Keep the books' caches out of the user's, and start from an empty one.
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='berg-tests-')
+atexit.register(shutil.rmtree, os.environ['XDG_CACHE_HOME'], True)
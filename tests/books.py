@@ -0,0 +1,33 @@
+import os
+import zipfile
+
+CONTAINER = ('<?xml version="1.0"?><container version="1.0" '
+             'xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+             '<rootfile full-path="%s" media-type="application/oebps-package+xml"/>'
+             '</rootfiles></container>')
+
+def write_epub(path, members, opf='OEBPS/content.opf'):
+    """Write a book to path with the mimetype, and members, a list of (name,
+    data), with a container pointing at opf if they lack one.  Unicode names
+    are flagged as UTF-8 in the archive, while byte strings are written as
+    they are."""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+        if 'META-INF/container.xml' not in [name for name, data in members]:
+            z.writestr('META-INF/container.xml', CONTAINER % opf)
+        for name, data in members:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            z.writestr(zipfile.ZipInfo(name), data, zipfile.ZIP_DEFLATED)
+
+def pack_epub(directory, path):
+    """Write the files under directory to a book at path."""
+    members = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            with open(filename, 'rb') as f:
+                members.append((os.path.relpath(filename, directory).replace(os.sep, '/'),
+                                f.read()))
+    write_epub(path, members)
@@ -0,0 +1,51 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import bookcache
+
+
+class WriteTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.json')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_write_atomic(self):
+        bookcache.write_atomic(self.path, 'first')
+        bookcache.write_atomic(self.path, 'second')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), 'second')
+        self.assertEqual(os.listdir(self.dir), ['data.json'])
+        # Into a directory that isn't there, nothing happens.
+        bookcache.write_atomic(os.path.join(self.dir, 'missing', 'data.json'), 'third')
+    
+    def test_json(self):
+        self.assertIsNone(bookcache.read_json(self.path))
+        bookcache.write_json(self.path, {'pages': [1, 2]})
+        self.assertEqual(bookcache.read_json(self.path),
+                         {'pages': [1, 2], 'version': bookcache.CACHE_VERSION})
+        bookcache.write_atomic(self.path, '{"pages": [1, 2], "version": 0}')
+        self.assertIsNone(bookcache.read_json(self.path))
+        bookcache.write_atomic(self.path, '{"pages": [1, 2')
+        self.assertIsNone(bookcache.read_json(self.path))
+    
+    def test_prune_dir(self):
+        now = time.time()
+        for i, name in enumerate(['old', 'middle', 'new', 'crashed.tmp', 'writing.tmp']):
+            path = os.path.join(self.dir, name)
+            with open(path, 'wb') as f:
+                f.write('x' * 100)
+            os.utime(path, (now - 10000 + 1000 * i, now - 10000 + 1000 * i))
+        os.utime(os.path.join(self.dir, 'writing.tmp'), None)
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        bookcache.prune_dir(self.dir, 250)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['middle', 'new', 'sub', 'writing.tmp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+import bookcache
+from epubserver import Epub
+from tests.books import write_epub
+
+OPF = u'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Café</dc:title>
+    <dc:identifier id="id">urn:x:café</dc:identifier>
+  </metadata>
+  <manifest>
+    <item id="a" href="Text/caf%C3%A9.xhtml" media-type="application/xhtml+xml"/>
+    <item id="b" href="Text/thé.xhtml" media-type="application/xhtml+xml"/>
+    <item id="i" href="Images/l%C3%A9gume.png" media-type="image/png"/>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+  </manifest>
+  <spine toc="ncx"><itemref idref="a"/><itemref idref="b"/></spine>
+</package>'''
+NCX = u'''<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/"><navMap>
+  <navPoint><navLabel><text>Café</text></navLabel><content src="Text/caf%C3%A9.xhtml"/></navPoint>
+  <navPoint><navLabel><text>Thé</text></navLabel><content src="Text/thé.xhtml#t"/></navPoint>
+</navMap></ncx>'''
+CHAPTER = u'<html><body><p>Café</p><img src="../Images/légume.png"/><a href="th%C3%A9.xhtml">Thé</a></body></html>'
+
+
+class NonASCIINamesTest(unittest.TestCase):
+    """Books whose member names aren't ASCII, flagged as UTF-8 or not, open
+    the same from the OPF and from the cache."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'book.epub')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def write(self, flagged):
+        def name(name):
+            return name if flagged else name.encode('utf-8')
+        write_epub(self.path, [('OEBPS/content.opf', OPF),
+                               ('OEBPS/toc.ncx', NCX),
+                               (name(u'OEBPS/Text/café.xhtml'), CHAPTER),
+                               (name(u'OEBPS/Text/thé.xhtml'), u'<html><body id="t"/></html>'),
+                               (name(u'OEBPS/Images/légume.png'), 'PNG')])
+    
+    def open(self):
+        epub = Epub(self.path)
+        self.addCleanup(epub.close)
+        return epub
+    
+    def check_reopen(self):
+        first = self.open()
+        self.assertIn('opf', first.parse_times)
+        second = self.open()
+        self.assertIn('cached', second.parse_times)
+        for epub in first, second:
+            self.assertEqual(epub.metadata['title'], u'Café')
+            self.assertEqual(epub.identifiers, [u'urn:x:café'])
+            self.assertEqual([entry['title'] for entry in epub.contents], [u'Café', u'Thé'])
+            chapter = epub.get_member(epub.spine[0])
+            self.assertEqual(epub.read_component(epub.spine[0]), CHAPTER.encode('utf-8'))
+            self.assertEqual(epub.read_component(epub.spine[1]), '<html><body id="t"/></html>')
+            self.assertEqual(sorted(epub.get_member(entry['src'].partition('#')[0]).filename
+                                    for entry in epub.contents),
+                             sorted(epub.get_member(href).filename for href in epub.spine))
+            self.assertEqual(sorted(epub.read(info) for info in
+                                    epub.linked_members(chapter, epub.read(chapter))),
+                             ['<html><body id="t"/></html>', 'PNG'])
+            self.assertEqual(epub.spine_position(chapter), 0)
+        self.assertEqual(first.snapshot(), second.snapshot())
+    
+    def test_unflagged_names(self):
+        self.write(False)
+        self.check_reopen()
+    
+    def test_flagged_names(self):
+        self.write(True)
+        self.check_reopen()
+    
+    def test_bad_snapshot(self):
+        self.write(False)
+        epub = self.open()
+        bookcache.save(epub, dict(epub.snapshot(), members={'OEBPS/toc.ncx': 99}))
+        epub = self.open()
+        self.assertIn('opf', epub.parse_times)
+        self.assertEqual(epub.get_member('OEBPS/toc.ncx').filename, 'OEBPS/toc.ncx')
+
+
+class ReadRangeTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'book.epub')
+        self.data = ''.join(chr(i % 256) for i in range(5000))
+        write_epub(self.path, [('OEBPS/content.opf', OPF), ('OEBPS/toc.ncx', NCX)])
+        with zipfile.ZipFile(self.path, 'a') as z:
+            z.writestr('stored.bin', self.data, zipfile.ZIP_STORED)
+            z.writestr('deflated.bin', self.data, zipfile.ZIP_DEFLATED)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_read_range(self):
+        epub = Epub(self.path)
+        self.addCleanup(epub.close)
+        for name in 'stored.bin', 'deflated.bin':
+            info = epub.getinfo(name)
+            self.assertEqual(epub.read_range(info, 0, info.file_size), self.data)
+            self.assertEqual(epub.read_range(info, 4000, 10), self.data[4000:4010])
+    
+    def test_bad_crc(self):
+        with open(self.path, 'r+b') as f:
+            archive = f.read()
+            f.seek(archive.index(self.data) + 100)
+            f.write('!')
+        epub = Epub(self.path)
+        self.addCleanup(epub.close)
+        info = epub.getinfo('stored.bin')
+        self.assertRaises(zipfile.BadZipfile, epub.read_range, info, 0, info.file_size)
+        self.assertEqual(epub.read_range(info, 200, 10), self.data[200:210])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+import unittest
+import fonts
+import optimize
+from epubserver import Epub
+from tests.books import write_epub
+
+OPF = u'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Repacked</dc:title>
+    <dc:creator>Zip Writer</dc:creator>
+    <dc:identifier id="id">urn:x:repacked</dc:identifier>
+    <meta name="cover" content="cover"/>
+  </metadata>
+  <manifest>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+    <item id="cover" href="Images/cover.jpg" media-type="image/jpeg"/>
+    <item id="one" href="Text/%(one)s" media-type="application/xhtml+xml"/>
+    <item id="two" href="Text/two.xhtml" media-type="application/xhtml+xml"/>
+    <item id="css" href="style.css" media-type="text/css"/>
+    <item id="font" href="Fonts/serif.otf" media-type="application/vnd.ms-opentype"/>
+  </manifest>
+  <spine toc="ncx"><itemref idref="two"/><itemref idref="one"/></spine>
+</package>'''
+NCX = u'''<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/"><navMap>
+  <navPoint><navLabel><text>Two</text></navLabel><content src="Text/two.xhtml"/></navPoint>
+  <navPoint><navLabel><text>One</text></navLabel><content src="Text/%(one)s#a"/>
+    <navPoint><navLabel><text>One.1</text></navLabel><content src="Text/%(one)s#b"/></navPoint>
+  </navPoint>
+</navMap></ncx>'''
+ENCRYPTION = '''<encryption xmlns="urn:oasis:names:tc:opendocument:xmlns:container"
+    xmlns:enc="http://www.w3.org/2001/04/xmlenc#">
+  <enc:EncryptedData>
+    <enc:EncryptionMethod Algorithm="http://www.idpf.org/2008/embedding"/>
+    <enc:CipherData><enc:CipherReference URI="OEBPS/Fonts/serif.otf"/></enc:CipherData>
+  </enc:EncryptedData>
+</encryption>'''
+FONT = ''.join(chr(i % 251) for i in range(4000))
+CHAPTER = u'<html><head><link href="../style.css" rel="stylesheet"/></head><body><p>%s</p></body></html>'
+
+
+class OptimizeTest(unittest.TestCase):
+    """Repacked books open the same as the originals."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'book.epub')
+        self.output = os.path.join(self.dir, 'out', 'book.epub')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def write(self, one, flagged=True):
+        """Write a book with its first chapter named one, out of spine order,
+        with an obfuscated font."""
+        key = fonts.font_key(fonts.IDPF, [u'urn:x:repacked'])
+        name = u'OEBPS/Text/' + one
+        if not flagged:
+            name = name.encode('utf-8')
+        quoted = one.encode('utf-8').replace('\xc3\xa9', '%C3%A9')
+        write_epub(self.source, [
+            ('META-INF/encryption.xml', ENCRYPTION),
+            ('OEBPS/Fonts/serif.otf', fonts.deobfuscate(FONT, fonts.IDPF, key)),
+            (name, CHAPTER % (u'<a id="a"/>' + u'Un é ' * 500 + u'<a id="b"/>')),
+            ('OEBPS/content.opf', OPF % {'one': quoted}),
+            ('OEBPS/toc.ncx', NCX % {'one': quoted}),
+            ('OEBPS/Images/cover.jpg', os.urandom(2000)),
+            ('OEBPS/Text/two.xhtml', CHAPTER % u'Deux'),
+            ('OEBPS/style.css', u'p { text-indent: 1em }')])
+    
+    def check_optimized(self):
+        result = optimize.optimize_book((self.source, self.output))
+        self.assertIsNone(result[-1])
+        original = optimize.ParsedEpub(self.source)
+        self.addCleanup(original.close)
+        for cls in optimize.IndexedEpub, Epub, optimize.ParsedEpub:
+            epub = cls(self.output)
+            self.addCleanup(epub.close)
+            if cls is not optimize.ParsedEpub:
+                self.assertIn('index', epub.parse_times)
+            for attr in 'spine', 'contents', 'metadata', 'cover', 'identifiers':
+                self.assertEqual(getattr(epub, attr), getattr(original, attr), attr)
+            self.assertEqual(epub.obfuscated, original.obfuscated)
+            self.assertEqual([epub.read_component(href) for href in epub.components()],
+                             [original.read_component(href) for href in original.components()])
+            for key, info in original.members.items():
+                self.assertEqual(epub.read(epub.members[key]), original.read(info), key)
+        # The mimetype comes first, stored, and so does the JPEG.
+        infos = epub.infolist()
+        self.assertEqual((infos[0].filename, infos[0].compress_type),
+                         ('mimetype', zipfile.ZIP_STORED))
+        self.assertEqual(epub.get_member('OEBPS/Images/cover.jpg').compress_type,
+                         zipfile.ZIP_STORED)
+        # Spine documents are in spine order, followed by what they use.
+        names = [info.filename for info in infos]
+        order = [names.index(epub.get_member(href).filename)
+                 for href in ('OEBPS/Text/two.xhtml', 'OEBPS/style.css', epub.spine[1])]
+        self.assertEqual(order, sorted(order))
+        font = epub.get_member('OEBPS/Fonts/serif.otf')
+        key = fonts.font_key(fonts.IDPF, epub.identifiers)
+        self.assertEqual(fonts.deobfuscate(epub.read(font), fonts.IDPF, key), FONT)
+    
+    def test_ascii_names(self):
+        self.write(u'one.xhtml')
+        self.check_optimized()
+    
+    def test_flagged_names(self):
+        self.write(u'uné.xhtml')
+        self.check_optimized()
+    
+    def test_unflagged_names(self):
+        self.write(u'uné.xhtml', flagged=False)
+        self.check_optimized()
+    
+    def test_unchanged_index(self):
+        # An optimized book optimizes to the same index.
+        self.write(u'uné.xhtml', flagged=False)
+        optimize.optimize_book((self.source, self.output))
+        again = os.path.join(self.dir, 'again.epub')
+        self.assertIsNone(optimize.optimize_book((self.output, again))[-1])
+        with zipfile.ZipFile(self.output) as first:
+            with zipfile.ZipFile(again) as second:
+                self.assertEqual(json.loads(second.read(optimize.INDEX_MEMBER)),
+                                 json.loads(first.read(optimize.INDEX_MEMBER)))
+
+
+if __name__ == '__main__':
+    unittest.main()
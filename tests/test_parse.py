@@ -0,0 +1,59 @@
+import os
+import glob
+import json
+import shutil
+import tempfile
+import unittest
+from epubserver import Epub
+from tests.books import pack_epub
+
+# Each book is unpacked in a directory here, next to a JSON file of the
+# spine, contents, and metadata the minidom parser made of it, before it
+# was replaced by the iterparse one.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'parse')
+
+
+class ParsedEpub(Epub):
+    use_cache = False
+    use_index = False
+
+
+class MinidomCompatibilityTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def check_books(self, cls, stage):
+        books = sorted(glob.glob(os.path.join(DATA_DIR, '*.json')))
+        self.assertTrue(books)
+        for expected in books:
+            name = os.path.splitext(os.path.basename(expected))[0]
+            path = os.path.join(self.dir, name + '.epub')
+            if not os.path.exists(path):
+                pack_epub(os.path.splitext(expected)[0], path)
+            with open(expected, 'rb') as f:
+                expected = json.loads(f.read().decode('utf-8'))
+            epub = cls(path)
+            try:
+                # Through JSON, as the page gets them
+                self.assertEqual(json.loads(json.dumps({'spine': epub.spine,
+                                                        'contents': epub.contents,
+                                                        'metadata': epub.metadata})),
+                                 expected, name)
+                self.assertIn(stage, epub.parse_times)
+            finally:
+                epub.close()
+    
+    def test_parse(self):
+        self.check_books(ParsedEpub, 'opf')
+    
+    def test_cached(self):
+        self.check_books(Epub, 'opf')
+        self.check_books(Epub, 'cached')
+
+
+if __name__ == '__main__':
+    unittest.main()
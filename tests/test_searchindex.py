@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from epubserver import Epub
+from searchindex import SearchIndex, extract_text
+from tests.books import write_epub
+
+OPF = ('<package xmlns="http://www.idpf.org/2007/opf"><metadata/><manifest>'
+       '<item id="a" href="a.xhtml"/><item id="b" href="b.xhtml"/><item id="c" href="c.xhtml"/>'
+       '</manifest><spine><itemref idref="a"/><itemref idref="b"/><itemref idref="c"/></spine>'
+       '</package>')
+CHAPTERS = ['<html><body><h1>The Whale</h1><p>Call me <i>Ish</i>mael.  Some years ago, '
+            'never mind how long.</p></body></html>',
+            '<html><body><p>%s the whale &amp; the sea</p></body></html>' % ('Water. ' * 100),
+            '<html><body><p>A sea without a whale.</p></body></html>']
+
+
+class SearchIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'book.epub')
+        write_epub(path, [('OEBPS/content.opf', OPF)] +
+                   [('OEBPS/%s.xhtml' % name, data) for name, data in zip('abc', CHAPTERS)])
+        self.epub = Epub(path)
+    
+    def tearDown(self):
+        self.epub.close()
+        shutil.rmtree(self.dir)
+    
+    def test_extract_text(self):
+        self.assertEqual(extract_text(CHAPTERS[0]),
+                         u'The Whale Call me Ishmael. Some years ago, never mind how long.')
+    
+    def test_search(self):
+        index = SearchIndex.for_book(self.epub)
+        hits = index.search('whale')
+        self.assertEqual([(hit['index'], hit['offset']) for hit in hits],
+                         [(0, 4), (1, 704), (2, 16)])
+        for hit in hits:
+            start, length = hit['match']
+            self.assertEqual(hit['snippet'][start:start + length].lower(), u'whale')
+        self.assertTrue(hits[1]['snippet'].endswith(u'Water. the whale & the sea'))
+        self.assertEqual(hits[1]['truncated'], [True, False])
+        # Only the components with both, at the rarer word
+        self.assertEqual([(hit['index'], hit['offset']) for hit in index.search('SEA whale')],
+                         [(1, 716), (2, 2)])
+        self.assertEqual(index.search('whale', limit=1), hits[:1])
+        self.assertEqual(index.search('whale kraken'), [])
+        self.assertEqual(index.search('  '), [])
+    
+    def test_cached(self):
+        built = SearchIndex.for_book(self.epub)
+        cached = SearchIndex.for_book(self.epub)
+        self.assertEqual(cached.components, built.components)
+        self.assertEqual(cached.starts, built.starts)
+        self.assertEqual(cached.postings, built.postings)
+        self.assertEqual(cached.search('sea whale'), built.search('sea whale'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import bisect
+import struct
+import zipfile
+import zlib
+
+# Layout of a zip local file header; matches zipfile.structFileHeader.
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_FILENAME_LENGTH = 10
+_EXTRA_FIELD_LENGTH = 11
+
+def data_offset(fp, info):
+    """Return the offset within the archive of the first byte of info's data."""
+    fp.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(fp.read(LOCAL_HEADER.size))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad local file header for %s" % info.filename)
+    return (info.header_offset + LOCAL_HEADER.size + header[_FILENAME_LENGTH] +
+            header[_EXTRA_FIELD_LENGTH])
+
+
+def start_point():
+    """A SeekIndex point for the beginning of a deflated member."""
+    return (0, 0, zlib.decompressobj(-zlib.MAX_WBITS))
+
+
+class LimitedReader(object):
+    """Read at most length bytes from the file-like f.  Closing the reader
+    closes f if owned is true."""
+    
+    def __init__(self, f, length, owned=True):
+        self.f = f
+        self.remaining = length
+        self.owned = owned
+    
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+    
+    def close(self):
+        if self.owned:
+            self.f.close()
+
+
+class InflateReader(object):
+    """Read the output of a raw deflate stream, resuming from a SeekIndex point."""
+    
+    block_size = 16 * 1024
+    
+    def __init__(self, fp, offset, compress_size, point, start, length, owned=True):
+        out_pos, in_pos, decompressor = point
+        self.fp = fp
+        self.owned = owned
+        self.fp.seek(offset + in_pos)
+        self.in_remaining = compress_size - in_pos
+        self.decompressor = decompressor.copy()
+        self.pending = b''
+        self.remaining = start - out_pos
+        while self.remaining:
+            if not self.read(self.block_size):
+                break
+        self.remaining = length
+    
+    def _inflate(self, n):
+        if not self.pending and self.in_remaining:
+            self.pending = self.fp.read(min(self.block_size, self.in_remaining))
+            self.in_remaining -= len(self.pending)
+            if not self.pending:
+                self.in_remaining = 0
+        data = self.decompressor.decompress(self.pending, n)
+        self.pending = self.decompressor.unconsumed_tail
+        return data
+    
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        chunks = []
+        got = 0
+        while got < n:
+            data = self._inflate(n - got)
+            if not data and not self.pending and not self.in_remaining:
+                break
+            chunks.append(data)
+            got += len(data)
+        self.remaining -= got
+        return b''.join(chunks)
+    
+    def close(self):
+        if self.owned:
+            self.fp.close()
+
+
+class SeekIndex(object):
+    """Snapshots of the decompressor taken every span bytes of output, so that
+    reading a deflated member from an offset only inflates from the nearest
+    snapshot instead of from the start of the member."""
+    
+    span = 1024 * 1024
+    
+    def __init__(self, fp, offset, info):
+        self.compress_size = info.compress_size
+        self.points = [start_point()]
+        decompressor = self.points[0][2].copy()
+        fp.seek(offset)
+        in_pos = out_pos = last = 0
+        while in_pos < self.compress_size:
+            data = fp.read(min(InflateReader.block_size, self.compress_size - in_pos))
+            if not data:
+                break
+            in_pos += len(data)
+            while data:
+                out_pos += len(decompressor.decompress(data, InflateReader.block_size))
+                data = decompressor.unconsumed_tail
+            if out_pos - last >= self.span:
+                self.points.append((out_pos, in_pos, decompressor.copy()))
+                last = out_pos
+        self.offsets = [point[0] for point in self.points]
+    
+    def open(self, fp, offset, start, length, owned=True):
+        point = self.points[bisect.bisect_right(self.offsets, start) - 1]
+        return InflateReader(fp, offset, self.compress_size, point, start, length, owned)
+
+
+def parse_range(header, size):
+    """Parse a single-range Range header into an inclusive (start, end) pair.
+    
+    Returns None if the header is absent or should be ignored, and raises
+    ValueError if the range can't be satisfied for a body of the given size.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[6:].strip()
+    if ',' in spec:  # Multiple ranges; sending the whole body is allowed
+        return None
+    first, _, last = spec.partition('-')
+    try:
+        if not first:
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end and start < size:  # Invalid, so ignored
+        return None
+    if start >= size:
+        raise ValueError("Unsatisfiable range %s" % spec)
+    return start, end